@@ -0,0 +1,284 @@
+'''
+Benchmark suite for the CapsNet components on synthetic inputs.
+
+Every component runs in its own process, so that its peak RSS is measured in
+isolation. Results are written as JSON; --compare flags regressions against a
+previously saved result file.
+
+Usage:
+    python benchmarks/capsNetBench.py --batchSize 4 --imageSize 64 --out bench.json
+    python benchmarks/capsNetBench.py ... --compare baseline.json --threshold 0.1
+    python benchmarks/capsNetBench.py --batchSize 2 --imageSize 48 --check
+'''
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import models.matrixCapsules as capsNet
+import utils
+
+COMPONENTS = ['primary_caps', 'convcaps1', 'convcaps2', 'classcaps', 'capsnet_forward',
+              'capsnet_train_step', 'seg', 'encode_labels', 'one_hot', 'presence',
+              'reverse_one_hot', 'index_to_color']
+
+parser = argparse.ArgumentParser(description='CapsNet component benchmarks')
+parser.add_argument('--batchSize', default=4, type=int,
+            help='mini-batch size (default: 4)')
+parser.add_argument('--imageSize', default=64, type=int,
+            help='height/width of the input image (default: 64)')
+parser.add_argument('--A', default=32, type=int, help='conv1 channels (default: 32)')
+parser.add_argument('--B', default=32, type=int, help='primary capsule types (default: 32)')
+parser.add_argument('--C', default=32, type=int, help='convcaps1 capsule types (default: 32)')
+parser.add_argument('--D', default=32, type=int, help='convcaps2 capsule types (default: 32)')
+parser.add_argument('--E', default=20, type=int, help='class capsules (default: 20)')
+parser.add_argument('--r', default=3, type=int, help='routing iterations (default: 3)')
+parser.add_argument('--recompute', default='',
+            help='comma separated capsule layers recomputed in the backward pass (default: none)')
+parser.add_argument('--topk', default=0, type=int,
+            help='sparse top-k routing, 0 routes to all capsule types (default: 0)')
+parser.add_argument('--log-routing', dest='log_routing', action='store_true',
+            help='run the E-step in the log domain')
+parser.add_argument('--iterations', default=10, type=int,
+            help='timed iterations per component (default: 10)')
+parser.add_argument('--warmup', default=2, type=int,
+            help='untimed iterations per component (default: 2)')
+parser.add_argument('--threads', default=0, type=int,
+            help='torch threads, 0 keeps the default (default: 0)')
+parser.add_argument('--check', action='store_true',
+            help='instead of benchmarking, check log-domain against linear routing in float32 '
+                 'and a bfloat16 autocast forward and backward for NaNs')
+parser.add_argument('--tol', default=1e-5, type=float,
+            help='largest difference between log-domain and linear routing in --check (default: 1e-5)')
+parser.add_argument('--components', default=','.join(COMPONENTS),
+            help='comma separated components to run (default: all)')
+parser.add_argument('--json', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+            '..', 'dataset', 'cityscapesClasses.json'),
+            help='path to the class definitions')
+parser.add_argument('--out', default='',
+            help='write the results to this JSON file')
+parser.add_argument('--compare', default='',
+            help='baseline JSON file to compare the results against')
+parser.add_argument('--threshold', default=0.1, type=float,
+            help='relative slowdown / memory growth flagged as a regression (default: 0.1)')
+
+def capsuleInput(b, channels, width):
+    '''
+        Synthetic capsule layer input: poses and activations in [0, 1].
+    '''
+    return torch.rand(b, channels, width, width)
+
+def buildComponent(name, args):
+    '''
+        Returns a function running one iteration of the component on a
+        synthetic batch.
+    '''
+    b, S = args.batchSize, args.imageSize
+    # spatial sizes after conv1, convcaps1 and convcaps2
+    w1 = (S - 5) // 2 + 1
+    w2 = (w1 - 3) // 2 + 1
+    w3 = w2 - 2
+    key = utils.disentangleKey(json.load(open(args.json))['classes'])
+    nc = len(key) + 1
+    torch.manual_seed(0)
+    np.random.seed(0)
+
+    if name == 'primary_caps':
+        layer = capsNet.PrimaryCaps(args.A, args.B)
+        x = torch.rand(b, args.A, w1, w1)
+        return lambda: layer(x)
+    if name in ('convcaps1', 'convcaps2', 'classcaps'):
+        net = capsNet.CapsNet(args.A, args.B, args.C, args.D, args.E, args.r,
+                              log_domain=args.log_routing, routing_topk=args.topk)
+        layer = getattr(net, name)
+        x = {'convcaps1': capsuleInput(b, args.B * 17, w1),
+             'convcaps2': capsuleInput(b, args.C * 17, w2),
+             'classcaps': capsuleInput(b, args.D * 17, w3)}[name]
+        def run():
+            with torch.no_grad():
+                layer(x, 0.5)
+        return run
+    if name == 'capsnet_forward':
+        net = capsNet.CapsNet(args.A, args.B, args.C, args.D, args.E, args.r,
+                              log_domain=args.log_routing, routing_topk=args.topk).eval()
+        x = torch.rand(b, 3, S, S)
+        def run():
+            with torch.no_grad():
+                net(x, 0.5)
+        return run
+    if name == 'capsnet_train_step':
+        net = capsNet.CapsNet(args.A, args.B, args.C, args.D, args.E, args.r,
+                              log_domain=args.log_routing, routing_topk=args.topk,
+                              checkpoint=args.recompute.split(','))
+        optimizer = torch.optim.Adam(net.parameters(), lr=1e-3)
+        x = torch.rand(b, 3, S, S)
+        def run():
+            optimizer.zero_grad()
+            out, seg = net(x, 0.5)
+            loss = out.pow(2).mean() + seg.pow(2).mean()
+            loss.backward()
+            optimizer.step()
+        return run
+    if name == 'seg':
+        seg = capsNet.segmentationNet(args.E)
+        x = torch.rand(b, args.E * 17, 1, 1)
+        def run():
+            with torch.no_grad():
+                seg(x)
+        return run
+
+    palette = np.array([key[k] for k in range(len(key))] + [[0, 0, 0]])
+    gt = palette[np.random.randint(len(palette), size=(b, S, S))].transpose(0, 3, 1, 2)
+    gt = torch.from_numpy(gt).float()
+    label = utils.encodeLabels(gt, key)
+    if name == 'encode_labels':
+        return lambda: utils.encodeLabels(gt, key)
+    if name == 'one_hot':
+        return lambda: utils.generateOneHot(gt, key)
+    if name == 'presence':
+        return lambda: utils.generatePresenceVector(gt, key)
+    if name == 'reverse_one_hot':
+        scores = torch.rand(b, nc, S, S).numpy()
+        return lambda: utils.reverseOneHot(scores, key)
+    if name == 'index_to_color':
+        return lambda: utils.indexToColor(label, key)
+    raise ValueError('Unknown component: %s' % name)
+
+def checkRouting(args):
+    '''
+        Compares log-domain and linear EM routing in float32 on the same
+        weights and input, and runs a bfloat16 autocast forward and
+        backward with log-domain routing. Returns the list of failures.
+    '''
+    b, S = args.batchSize, args.imageSize
+    failures = []
+    torch.manual_seed(0)
+    linear = capsNet.CapsNet(args.A, args.B, args.C, args.D, args.E, args.r)
+    log = capsNet.CapsNet(args.A, args.B, args.C, args.D, args.E, args.r, log_domain=True)
+    log.load_state_dict(linear.state_dict())
+    torch.manual_seed(1)
+    x = torch.rand(b, 3, S, S)
+
+    linear.eval(), log.eval()
+    with torch.no_grad():
+        for name, a, l in zip(('class capsules', 'segmentation'), linear(x, 0.5), log(x, 0.5)):
+            diff = (a - l).abs().max().item()
+            print('float32 log-domain vs linear %-16s max diff %.3g' % (name, diff))
+            if not diff <= args.tol:
+                failures.append('%s differ by %.3g (tolerance %.3g)' % (name, diff, args.tol))
+
+    log.train()
+    with torch.autocast('cpu', dtype=torch.bfloat16):
+        out, seg = log(x, 0.5)
+    (out.float().pow(2).mean() + seg.float().pow(2).mean()).backward()
+    for name, t in [('class capsules', out), ('segmentation', seg)] + \
+            [(n + ' grad', p.grad) for n, p in log.named_parameters() if p.grad is not None]:
+        if not torch.isfinite(t).all():
+            failures.append('bfloat16 autocast: non-finite values in %s' % name)
+    print('bfloat16 autocast forward and backward: %s'
+          % ('non-finite values' if any('bfloat16' in f for f in failures) else 'finite'))
+    return failures
+
+def runComponent(name, args, queue):
+    '''
+        Runs one component in the current (child) process and puts its
+        results on the queue.
+    '''
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    run = buildComponent(name, args)
+    rss_setup = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    for _ in range(args.warmup):
+        run()
+    times = []
+    for _ in range(args.iterations):
+        t = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - t)
+    times = np.array(times) * 1e3
+    rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    queue.put({'component': name,
+               'throughput': args.batchSize / (times.mean() / 1e3),
+               'latency_mean_ms': float(times.mean()),
+               'latency_p50_ms': float(np.percentile(times, 50)),
+               'latency_p90_ms': float(np.percentile(times, 90)),
+               'latency_p99_ms': float(np.percentile(times, 99)),
+               'peak_rss_mb': rss_peak,
+               'rss_increase_mb': rss_peak - rss_setup})
+
+def compare(results, baseline, threshold):
+    '''
+        Returns the list of regressions of results against baseline: a p50
+        latency or peak RSS growth larger than threshold.
+    '''
+    regressions = []
+    base = {r['component']: r for r in baseline['results']}
+    for r in results:
+        old = base.get(r['component'])
+        if old is None:
+            continue
+        for metric in ('latency_p50_ms', 'peak_rss_mb'):
+            if old[metric] > 0 and r[metric] > old[metric] * (1 + threshold):
+                regressions.append('%s %s: %.2f -> %.2f (+%.0f%%)'
+                                   % (r['component'], metric, old[metric], r[metric],
+                                      100 * (r[metric] / old[metric] - 1)))
+    return regressions
+
+def main():
+    args = parser.parse_args()
+    if args.check:
+        if args.threads:
+            torch.set_num_threads(args.threads)
+        failures = checkRouting(args)
+        for line in failures:
+            print('FAILED ' + line)
+        if failures:
+            raise SystemExit(1)
+        return
+    ctx = multiprocessing.get_context('spawn')
+    results = []
+    print('%-20s %12s %10s %10s %10s %10s' % ('component', 'samples/s', 'p50 ms',
+                                              'p90 ms', 'p99 ms', 'RSS MB'))
+    for name in args.components.split(','):
+        queue = ctx.Queue()
+        proc = ctx.Process(target=runComponent, args=(name, args, queue))
+        proc.start()
+        proc.join()
+        if proc.exitcode != 0:
+            print('%-20s failed with exit code %d' % (name, proc.exitcode))
+            continue
+        r = queue.get()
+        results.append(r)
+        print('%-20s %12.1f %10.2f %10.2f %10.2f %10.1f'
+              % (name, r['throughput'], r['latency_p50_ms'], r['latency_p90_ms'],
+                 r['latency_p99_ms'], r['peak_rss_mb']))
+
+    report = {'config': {k: v for k, v in vars(args).items()
+                         if k not in ('out', 'compare', 'json')},
+              'machine': {'platform': platform.platform(), 'torch': torch.__version__,
+                          'threads': torch.get_num_threads()},
+              'results': results}
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for line in regressions:
+            print('REGRESSION ' + line)
+        if regressions:
+            raise SystemExit(1)
+        print('No regressions against %s' % args.compare)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+'''
+Microbenchmark for the groundtruth label encoders in utils.
+
+Compares the batched colour lookup encoders against the original per-class
+loop implementations, which are kept below as the reference, and checks that
+both produce identical outputs.
+
+Usage: python benchmarks/labelEncoding.py --batchSize 4 --imageSize 64
+'''
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import utils
+
+parser = argparse.ArgumentParser(description='Label encoding microbenchmark')
+parser.add_argument('--batchSize', default=4, type=int,
+            help='mini-batch size (default: 4)')
+parser.add_argument('--imageSize', default=64, type=int,
+            help='height/width of the groundtruth images (default: 64)')
+parser.add_argument('--repeat', default=5, type=int,
+            help='number of timed runs per encoder (default: 5)')
+parser.add_argument('--json', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+            '..', 'dataset', 'cityscapesClasses.json'),
+            help='path to the class definitions')
+parser.add_argument('--device', default=None,
+            help='device for the batched encoders, e.g. cuda (default: cpu)')
+
+def referencePresenceVector(batch, key):
+    '''
+        Generate a vector with dimensions of classes equal to the number of
+        classes. Each elements corresponds to the presence of a particular
+        class in the image: It is 1 if a certain class is present, or 0 if it
+        is absent.
+    '''
+    batch = batch.numpy()
+    # Iterate over all images in a batch
+    for i in range(len(batch)):
+        img = batch[i,:,:,:]
+        imgSize = img.shape[1] * img.shape[2]
+        img = np.transpose(img, (1,2,0))
+        presence = np.zeros(len(key) + 1) # +1 for the background class
+
+        # Iterate over all the key-value pairs in the class Key dict
+        for k in range(len(key)):
+            rgb = key[k]
+            mask = np.where(np.all(img == rgb, axis = -1))
+            presence[k] = len(mask[0])/imgSize
+
+        # Check for background pixels [0,0,0]
+        rgb = np.array([0,0,0])
+        mask = np.where(np.all(img == rgb, axis = -1))
+        presence[19] = len(mask[0])/imgSize
+
+        presence = torch.from_numpy(presence).unsqueeze(0)
+
+        if 'label' in locals():
+            label = torch.cat((label, presence), 0)
+        else:
+            label = presence
+
+    return label
+
+def referenceOneHot(gt, key):
+    '''
+        Generates the one-hot encoded tensor for a batch of images based on
+        their class.
+    '''
+
+    batch = gt.numpy()
+    # Iterate over all images in a batch
+    for i in range(len(batch)):
+        img = batch[i,:,:,:]
+        img = np.transpose(img, (1,2,0))
+        catMask = np.ones((img.shape[0], img.shape[1]))
+        # Multiply by 19 since 19 is considered label for the background class
+
+        # Iterate over all the key-value pairs in the class Key dict
+        for k in range(len(key) + 1):
+            catMask = catMask * 0
+            if k == 19:
+                rgb = [0, 0, 0]
+            else:
+                rgb = key[k]
+            mask = np.where(np.all(img == rgb, axis = -1))
+            catMask[mask] = 1
+
+            catMaskTensor = torch.from_numpy(catMask).unsqueeze(0)
+            if 'oneHot' in locals():
+                oneHot = torch.cat((oneHot, catMaskTensor), 0)
+            else:
+                oneHot = catMaskTensor
+
+    label = oneHot.view(len(batch),len(key)+1,img.shape[0],img.shape[1])
+    return label
+
+def referenceGTmask(batch, key):
+    '''
+        Generates the category-wise encoded vector for the segmentation classes
+        for a batch of images.
+        Returns a tensor of size: [batchSize, imgSize**2, 1]
+    '''
+    batch = batch.numpy()
+    # Iterate over all images in a batch
+    for i in range(len(batch)):
+        img = batch[i,:,:,:]
+        img = np.transpose(img, (1,2,0))
+        cat_mask = np.ones((img.shape[0], img.shape[1]))
+        # Multiply by 19 since 19 is considered label for the background class
+        cat_mask = cat_mask * 19
+
+        # Iterate over all the key-value pairs in the class Key dict
+        for k in range(len(key)):
+            rgb = key[k]
+            mask = np.where(np.all(img == rgb, axis = -1))
+            cat_mask[mask] = k
+
+        cat_mask = torch.from_numpy(cat_mask).view(-1,1).unsqueeze(0)
+
+        if 'label' in locals():
+            label = torch.cat((label, cat_mask), 0)
+        else:
+            label = cat_mask
+        #print('img copy masked')
+        #print(img_copy)
+
+    label = torch.squeeze(label, dim=2)
+    return label
+
+def syntheticGT(batchSize, imageSize, key):
+    '''
+        Random groundtruth batch in [0, 255] (as the trainer sees it after
+        gt * 255) made of class colours, background and a few unknown colours.
+    '''
+    palette = np.array([key[k] for k in range(len(key))] + [[0,0,0], [1,2,3], [250,250,250]])
+    idxs = np.random.randint(len(palette), size=(batchSize, imageSize, imageSize))
+    gt = palette[idxs].transpose(0,3,1,2)
+    return torch.from_numpy(gt).float()
+
+def timeit(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        t = time.time()
+        fn()
+        times.append(time.time() - t)
+    return min(times)
+
+def main():
+    args = parser.parse_args()
+    key = utils.disentangleKey(json.load(open(args.json))['classes'])
+    gt = syntheticGT(args.batchSize, args.imageSize, key)
+
+    pairs = [('generatePresenceVector', referencePresenceVector, utils.generatePresenceVector),
+             ('generateOneHot', referenceOneHot, utils.generateOneHot),
+             ('generateGTmask', referenceGTmask, utils.generateGTmask)]
+    print('batchSize %d, imageSize %d' % (args.batchSize, args.imageSize))
+    for name, reference, batched in pairs:
+        expected = reference(gt, key)
+        got = batched(gt, key)
+        if not torch.equal(expected, got.cpu()):
+            raise AssertionError('%s: batched output differs from the reference' % name)
+        t_ref = timeit(lambda: reference(gt, key), args.repeat)
+        t_new = timeit(lambda: batched(gt.to(args.device) if args.device else gt, key), args.repeat)
+        print('%-24s reference %8.2f ms | batched %8.2f ms | %6.1fx'
+              % (name, t_ref * 1e3, t_new * 1e3, t_ref / t_new))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+'''
+Load generator for the segmentation predictor.
+
+Runs concurrent clients sending synthetic images, either to an in-process
+Predictor or to a running HTTP server (--url), and reports the request
+latency percentiles and the throughput.
+
+Usage:
+    python benchmarks/predictorLoad.py --clients 8 --requests 200
+    python benchmarks/predictorLoad.py --url http://127.0.0.1:8000/predict
+'''
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import urllib.request
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import config
+import utils
+from predictor import Predictor
+
+parser = argparse.ArgumentParser(description='Predictor load generator')
+parser.add_argument('--url', default='',
+            help='predict endpoint of a running server (default: in-process predictor)')
+parser.add_argument('--net', default='',
+            help='path to the trained network for the in-process predictor')
+parser.add_argument('--config', default='',
+            help='run config the network was trained with, if --net does not store one (see config.py)')
+parser.add_argument('--json', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+            '..', 'dataset', 'cityscapesClasses.json'),
+            help='path to the class definitions')
+parser.add_argument('--imageSize', default=128, type=int,
+            help='height/width of the network input (default: 128)')
+parser.add_argument('--inputSize', default=256, type=int,
+            help='height/width of the images sent (default: 256)')
+parser.add_argument('--clients', default=8, type=int,
+            help='concurrent clients (default: 8)')
+parser.add_argument('--requests', default=100, type=int,
+            help='requests per client (default: 100)')
+parser.add_argument('--max-batch', dest='max_batch', default=8, type=int,
+            help='largest micro-batch of the in-process predictor (default: 8)')
+parser.add_argument('--max-wait', dest='max_wait', default=10, type=float,
+            help='milliseconds a request waits for a micro-batch (default: 10)')
+parser.add_argument('--output', default='index', choices=['index', 'color'])
+parser.add_argument('--json-out', dest='json_out', default='',
+            help='write the results to this JSON file')
+
+def main():
+    args = parser.parse_args()
+    image = np.random.randint(0, 256, (args.inputSize, args.inputSize, 3), dtype=np.uint8)
+
+    if args.url:
+        body = cv2.imencode('.png', image)[1].tobytes()
+        url = '%s?output=%s' % (args.url, args.output)
+        def request():
+            with urllib.request.urlopen(urllib.request.Request(url, data=body)) as r:
+                r.read()
+    else:
+        key = utils.disentangleKey(json.load(open(args.json))['classes'])
+        predictor = Predictor(key, args.net, args.imageSize, max_batch=args.max_batch,
+                              max_wait=args.max_wait / 1e3,
+                              **config.capsNetKwargs(config.loadConfig(args.config), len(key) + 1))
+        predictor.predict([image], args.output) # warm up
+        def request():
+            predictor.submit(image, args.output).result()
+
+    latencies = [[] for _ in range(args.clients)]
+    def client(i):
+        for _ in range(args.requests):
+            t = time.perf_counter()
+            request()
+            latencies[i].append(time.perf_counter() - t)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(args.clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    latencies = np.concatenate(latencies) * 1e3
+    results = {'clients': args.clients, 'requests': len(latencies),
+               'throughput': len(latencies) / elapsed,
+               'latency_p50_ms': float(np.percentile(latencies, 50)),
+               'latency_p99_ms': float(np.percentile(latencies, 99)),
+               'latency_mean_ms': float(latencies.mean())}
+    print('%d requests from %d clients in %.2fs: %.1f images/s | p50 %.1f ms | p99 %.1f ms'
+          % (results['requests'], args.clients, elapsed, results['throughput'],
+             results['latency_p50_ms'], results['latency_p99_ms']))
+    if args.json_out:
+        with open(args.json_out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+'''
+Runs a CapsNet exported with export.py.
+
+Only depends on torch, so it can be shipped without the training code:
+
+    import capsNetRuntime
+    module, meta = capsNetRuntime.load('capsnet_128.pt')
+    activations, seg = module(images) # images: [b, 3, imageSize, imageSize] in [0, 1]
+'''
+
+import json
+
+import torch
+
+def load(path, device=None):
+    '''
+        Loads an exported network.
+        Returns the module in eval mode and its metadata: the imageSize,
+        num_classes, routing iterations of every capsule layer and lambda it
+        was exported with.
+    '''
+    extra = {'metadata.json': ''}
+    module = torch.jit.load(path, map_location=device, _extra_files=extra)
+    module.eval()
+    return module, json.loads(extra['metadata.json'] or '{}')
+
+def segment(module, images, meta):
+    '''
+        Segments a [b, 3, H, W] batch with values in [0, 1], where H and W
+        must be the exported imageSize.
+        Returns the [b, H, W] class index map at the size of the input.
+    '''
+    size = meta['imageSize']
+    if tuple(images.shape[-2:]) != (size, size):
+        raise ValueError('Expected %dx%d images, got %s' % (size, size, tuple(images.shape[-2:])))
+    with torch.no_grad():
+        _, seg = module(images)
+        seg = torch.nn.functional.interpolate(seg, size=(size, size), mode='bilinear',
+                                              align_corners=False)
+    return seg.argmax(1)
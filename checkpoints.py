@@ -0,0 +1,128 @@
+'''
+Resumable training checkpoints.
+
+A checkpoint holds everything needed to continue a run: the model, optimizer
+and scheduler state, the epoch and step counters, the lambda_/m schedule and
+the random number generator states. Checkpoints are copied to the CPU on the
+calling thread and written by a background thread, atomically, so neither an
+interrupted write nor a slow disk can corrupt or stall training.
+'''
+
+import os
+import queue
+import random
+import re
+import threading
+
+import numpy as np
+import torch
+
+_PATTERN = re.compile(r'^checkpoint_epoch_(\d+)\.pth$')
+
+def checkpointPath(save_dir, epoch):
+    return os.path.join(save_dir, 'checkpoint_epoch_%03d.pth' % epoch)
+
+def listCheckpoints(save_dir):
+    '''
+        Returns the checkpoints in save_dir, oldest first.
+    '''
+    if not os.path.isdir(save_dir):
+        return []
+    found = [(int(m.group(1)), name) for m, name in
+             ((_PATTERN.match(name), name) for name in os.listdir(save_dir)) if m]
+    return [os.path.join(save_dir, name) for _, name in sorted(found)]
+
+def latestCheckpoint(save_dir):
+    '''
+        Returns the path of the newest checkpoint in save_dir, or None.
+    '''
+    found = listCheckpoints(save_dir)
+    return found[-1] if found else None
+
+def rngState():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(),
+             'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def setRngState(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+def toCPU(obj):
+    '''
+        Copy of a (nested) state dict with every tensor copied to the CPU,
+        so it no longer changes with the training state.
+    '''
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, toCPU(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(toCPU(v) for v in obj)
+    return obj
+
+def modelState(checkpoint):
+    '''
+        Returns the model weights of a full checkpoint, or the checkpoint
+        itself if it only holds the weights (e.g. a --net file).
+    '''
+    if isinstance(checkpoint, dict) and 'model' in checkpoint and 'optimizer' in checkpoint:
+        return checkpoint['model']
+    return checkpoint
+
+class CheckpointSaver(object):
+    '''
+        Writes checkpoints to save_dir from a background thread and keeps
+        the newest keep of them (0 keeps all).
+    '''
+
+    def __init__(self, save_dir, keep=5):
+        self.save_dir = save_dir
+        self.keep = keep
+        self.queue = queue.Queue(1)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name='CheckpointSaver', daemon=True)
+        self.thread.start()
+
+    def save(self, state, epoch):
+        '''
+            Snapshots the state and queues it to be written as the checkpoint
+            of the epoch. Only waits if the previous checkpoint is still
+            being written.
+        '''
+        self._raise()
+        self.queue.put((toCPU(state), checkpointPath(self.save_dir, epoch)))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            state, path = item
+            try:
+                tmp = path + '.tmp'
+                torch.save(state, tmp)
+                os.replace(tmp, path)
+                if self.keep:
+                    for old in listCheckpoints(self.save_dir)[:-self.keep]:
+                        os.remove(old)
+            except Exception as e:
+                self.error = e
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        '''
+            Waits for the queued checkpoints to be written.
+        '''
+        self.queue.put(None)
+        self.thread.join()
+        self._raise()
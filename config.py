@@ -0,0 +1,118 @@
+'''
+Run configuration: data paths, the capsule stack and the lambda/m schedules.
+
+A config file (JSON, or YAML if PyYAML is installed) only needs the entries
+that differ from DEFAULT_CONFIG, it is merged into a copy of the defaults.
+The model section describes the network built by capsNetKwargs:
+
+    model:
+      A: 32                 # conv1 channels
+      B: 32                 # primary capsule types
+      conv1_kernel: 5
+      conv1_stride: 2
+      iterations: null      # routing iterations of every layer (null: --r)
+      layers:               # ConvCaps stack, see defaultCapsuleLayers
+        - {name: convcaps1, types: 32, kernel: 3, stride: 2}
+        - {name: convcaps2, types: 32, kernel: 3, stride: 1}
+        - {name: classcaps, kernel: 0, stride: 1,
+           coordinate_add: true, transform_share: true}
+
+A layer may set its own 'iterations'. The last layer has one type per class,
+its 'types' can be left out. The layer list replaces the default one as a
+whole.
+
+Both schedules start at 'start' (or at 'pretrained' when training from
+--net). While below 'max' they grow by increment/steps every training step,
+steps being len(train_loader)//batchSize as in main.train.
+'''
+
+import copy
+import json
+
+import models.matrixCapsules as capsNet
+
+DEFAULT_CONFIG = {
+    'data': {
+        'data_dir': '/media/salman/DATA/General Datasets/cityscapes',
+        # json path for class definitions
+        'json_path': '/home/salman/pytorch/capsNet/dataset/cityscapesClasses.json',
+    },
+    'model': {
+        'A': 32,
+        'B': 32,
+        'conv1_kernel': 5,
+        'conv1_stride': 2,
+        'iterations': None,
+        'layers': capsNet.defaultCapsuleLayers(32, 32, None),
+    },
+    'schedule': {
+        'lambda': {'start': 1e-3, 'increment': 0.2, 'max': 1.0, 'pretrained': 0.9},
+        'm': {'start': 0.2, 'increment': 0.2, 'max': 0.9, 'pretrained': 0.8},
+    },
+}
+
+def merge(base, override):
+    '''
+        Copy of base with the entries of override, merging nested dicts.
+    '''
+    merged = copy.deepcopy(base)
+    for k, v in override.items():
+        if isinstance(v, dict) and isinstance(merged.get(k), dict):
+            merged[k] = merge(merged[k], v)
+        else:
+            merged[k] = copy.deepcopy(v)
+    return merged
+
+def readFile(path):
+    '''
+        Contents of a JSON file, or of a YAML file if PyYAML is installed.
+    '''
+    with open(path) as f:
+        if path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError('Reading %s needs PyYAML (pip install pyyaml), '
+                                  'or use a JSON file' % path)
+            return yaml.safe_load(f) or {}
+        return json.load(f)
+
+def loadConfig(path=None):
+    '''
+        DEFAULT_CONFIG updated with the JSON or YAML file at path.
+    '''
+    if not path:
+        return copy.deepcopy(DEFAULT_CONFIG)
+    override = readFile(path)
+    unknown = set(override) - set(DEFAULT_CONFIG)
+    if unknown:
+        raise ValueError('Unknown config sections in %s: %s' % (path, ', '.join(sorted(unknown))))
+    return merge(DEFAULT_CONFIG, override)
+
+def runConfig(state=None, path=None):
+    '''
+        The run config stored in a checkpoint loaded by main.py, otherwise
+        the one at path (or the defaults), which must then be the one the
+        network was trained with.
+    '''
+    if isinstance(state, dict) and 'config' in state:
+        return merge(DEFAULT_CONFIG, state['config'])
+    return loadConfig(path)
+
+def capsNetKwargs(config, num_classes, r=3):
+    '''
+        CapsNet arguments for the model section of config, besides E
+        (num_classes) and r, which fill in the types of the last layer and
+        the iterations of every layer that does not set them.
+    '''
+    model = config['model']
+    layers = copy.deepcopy(model['layers'])
+    for layer in layers:
+        layer.setdefault('iterations', model.get('iterations') or r)
+    if layers[-1].get('types') is None:
+        layers[-1]['types'] = num_classes
+    return {'A': model['A'], 'B': model['B'], 'layers': layers, 'conv1_kernel': model['conv1_kernel'],
+            'conv1_stride': model['conv1_stride']}
+
+def layerNames(config):
+    return [layer['name'] for layer in config['model']['layers']]
@@ -0,0 +1,86 @@
+'''
+Batched transforms running on the training device.
+
+Replaces the per-sample PIL Resize + ToTensor of the data loader workers:
+the dataset returns uint8 batches as stored on disk (see the raw option of
+cityscapesDataset) and a BatchTransform resizes, augments and encodes them as
+tensor ops on the device. Images and labels are sampled with the same integer
+source coordinates, so labels stay integer class indices throughout.
+'''
+
+import torch
+
+import utils
+
+class BatchTransform(object):
+    '''
+        Resizes a batch to imageSize x imageSize (nearest neighbour, like the
+        PIL pipeline), with optional random zoom, crop and horizontal flip,
+        and converts colour groundtruth to class indices.
+
+        Args:
+            imageSize: height/width of the output
+            key: class key from utils.disentangleKey
+            device: device the transform runs on (default: the input's)
+            max_scale: zoom into the image by a random factor in
+                       [1, max_scale], cropping a random window (1: no crop)
+            flip: flip every sample horizontally with probability 0.5
+    '''
+
+    def __init__(self, imageSize, key, device=None, max_scale=1.0, flip=False):
+        self.imageSize = imageSize
+        self.key = key
+        self.device = device
+        self.max_scale = max_scale
+        self.flip = flip
+
+    def _sourceIndices(self, b, size, device):
+        '''
+            Source row (or column) of every output row (column) for each
+            sample, as a [b, imageSize] long tensor.
+        '''
+        S = self.imageSize
+        if self.max_scale > 1:
+            scale = 1 + torch.rand(b, 1, device=device) * (self.max_scale - 1)
+            crop = (size / scale).floor().clamp(min=1) # b,1
+            start = (torch.rand(b, 1, device=device) * (size - crop + 1)).floor()
+        else:
+            crop = torch.full((b, 1), float(size), device=device)
+            start = torch.zeros(b, 1, device=device)
+        # PIL's nearest neighbour: the source pixel containing the centre of
+        # the output pixel
+        centre = torch.arange(S, device=device, dtype=torch.float64).view(1, S) + 0.5
+        idx = start.double() + (centre * crop.double() / S).floor()
+        return idx.long().clamp(0, size - 1)
+
+    def __call__(self, images, gt):
+        '''
+            Args:
+                images: [b, 3, H, W] uint8 images
+                gt: [b, 3, H, W] uint8 colour groundtruth, or [b, H, W]
+                    uint8 class index maps
+            Returns the images as [b, 3, imageSize, imageSize] floats in
+            [0, 1] and the labels as [b, imageSize, imageSize] uint8 class
+            indices.
+        '''
+        device = self.device or images.device
+        images = images.to(device, non_blocking=True)
+        gt = gt.to(device, non_blocking=True)
+        b, _, H, W = images.shape
+
+        ys = self._sourceIndices(b, H, device) # b,S
+        xs = self._sourceIndices(b, W, device) # b,S
+        if self.flip:
+            flipped = torch.rand(b, 1, device=device) < 0.5
+            xs = torch.where(flipped, xs.flip(1), xs)
+        rows = torch.arange(b, device=device).view(b, 1, 1)
+        ys, xs = ys.view(b, -1, 1), xs.view(b, 1, -1)
+
+        images = images.permute(0, 2, 3, 1)[rows, ys, xs] # b,S,S,3
+        images = images.permute(0, 3, 1, 2).float().div_(255)
+        if gt.dim() == 4:
+            gt = gt.permute(0, 2, 3, 1)[rows, ys, xs].permute(0, 3, 1, 2) # b,3,S,S
+            label = utils.encodeLabels(gt, self.key)
+        else:
+            label = gt[rows, ys, xs]
+        return images.contiguous(), label
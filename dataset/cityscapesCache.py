@@ -0,0 +1,285 @@
+'''
+Offline preprocessing cache for the cityscapes dataset.
+
+Resizes every sample of a split once to the network input size and stores the
+image together with its uint8 class index map, so training does not decode
+full resolution groundtruth or match colours on every epoch.
+
+Samples are written either as PNG files, or with --shards as fixed-shape
+uint8 .npy shards plus an index, which the dataset reads through np.memmap.
+
+Usage:
+    python -m dataset.cityscapesCache --data-dir <cityscapes> \
+        --json dataset/cityscapesClasses.json --imageSize 64 --cache-dir <cache>
+    python -m dataset.cityscapesCache ... --shards [--verify]
+'''
+
+import argparse
+import hashlib
+import json
+import os
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+from PIL import Image
+
+import utils
+
+# Bump when the layout or the contents of the cache change
+CACHE_VERSION = 1
+
+def cacheKey(imageSize, json_path):
+    '''
+        Key identifying a cache: derived from the image size, the class
+        definitions and the cache version.
+    '''
+    h = hashlib.sha1()
+    with open(json_path, 'rb') as f:
+        h.update(f.read())
+    h.update(('%d:%d' % (imageSize, CACHE_VERSION)).encode())
+    return h.hexdigest()[:12]
+
+def cacheDir(cache_root, split, imageSize, json_path):
+    '''
+        Directory holding the cache of a split for the given image size and
+        class definitions.
+    '''
+    return os.path.join(cache_root, '%s_%d_%s' % (split, imageSize,
+                        cacheKey(imageSize, json_path)))
+
+def shardDir(cache_root, split, imageSize, json_path):
+    '''
+        Directory holding the shards of a split for the given image size and
+        class definitions.
+    '''
+    return cacheDir(cache_root, split, imageSize, json_path) + '_shards'
+
+def loadManifest(cache_dir):
+    '''
+        Returns the manifest of a cache directory, or None if the cache is
+        missing or was not completely written.
+    '''
+    return _loadJson(os.path.join(cache_dir, 'manifest.json'))
+
+def loadShardIndex(shard_dir):
+    '''
+        Returns the index of a shard directory, or None if the shards are
+        missing or were not completely written.
+    '''
+    return _loadJson(os.path.join(shard_dir, 'index.json'))
+
+def _loadJson(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def preprocessSample(img_name, gt_name, imageSize, key):
+    '''
+        Loads and resizes one sample.
+        Returns the image as a [H, W, 3] uint8 array and the class index map
+        as a [H, W] uint8 array.
+    '''
+    size = (imageSize, imageSize)
+    image = Image.open(img_name).convert('RGB').resize(size, Image.NEAREST)
+    gt = Image.open(gt_name).convert('RGB').resize(size, Image.NEAREST)
+    gt = torch.from_numpy(np.array(gt)).permute(2,0,1).unsqueeze(0)
+    label = utils.encodeLabels(gt, key)[0]
+    return np.asarray(image), label.numpy()
+
+def _writeSample(job):
+    img_name, gt_name, out_img, out_label, imageSize, key = job
+    image, label = preprocessSample(img_name, gt_name, imageSize, key)
+    for path in (out_img, out_label):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    Image.fromarray(image).save(out_img)
+    Image.fromarray(label).save(out_label)
+
+def buildCache(dataset, cache_root, imageSize, workers=4):
+    '''
+        Preprocesses every sample of a cityscapesDataset into its cache
+        directory. The manifest is written last, so an interrupted run leaves
+        an invalid cache behind rather than a partial one.
+    '''
+    out_dir = cacheDir(cache_root, dataset.type, imageSize, dataset.json_path)
+    # A manifest of an earlier build would validate the files rewritten below
+    _remove(os.path.join(out_dir, 'manifest.json'))
+    key = utils.disentangleKey(dataset.classes)
+    samples = dataset.relativeNames()
+    jobs = [(img_name, dataset.gtPath(img_name),
+             os.path.join(out_dir, 'images', name + '.png'),
+             os.path.join(out_dir, 'labels', name + '.png'), imageSize, key)
+            for img_name, name in zip(dataset.image_list, samples)]
+    with Pool(workers) as pool:
+        for i, _ in enumerate(pool.imap_unordered(_writeSample, jobs, chunksize=16)):
+            if (i + 1) % 500 == 0:
+                print('[%s] %d/%d' % (dataset.type, i + 1, len(jobs)))
+
+    manifest = {'version': CACHE_VERSION,
+                'key': cacheKey(imageSize, dataset.json_path),
+                'imageSize': imageSize,
+                'samples': samples}
+    _writeJson(manifest, os.path.join(out_dir, 'manifest.json'))
+    return out_dir
+
+def _remove(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+def _writeJson(obj, path):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp, path)
+
+def _preprocessJob(job):
+    img_name, gt_name, imageSize, key = job
+    return preprocessSample(img_name, gt_name, imageSize, key)
+
+def _sha1(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def buildShards(dataset, cache_root, imageSize, shard_size=1024, workers=4):
+    '''
+        Preprocesses every sample of a cityscapesDataset into uint8 shards:
+        images_XXX.npy of size [n, H, W, 3] and labels_XXX.npy of size
+        [n, H, W], in the order of dataset.image_list. The index (sample
+        names, shard sizes and checksums) of an earlier build is removed
+        first and the new one written last, so an interrupted run leaves no
+        valid index behind.
+    '''
+    out_dir = shardDir(cache_root, dataset.type, imageSize, dataset.json_path)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    _remove(os.path.join(out_dir, 'index.json'))
+    key = utils.disentangleKey(dataset.classes)
+    jobs = [(img_name, dataset.gtPath(img_name), imageSize, key)
+            for img_name in dataset.image_list]
+    shards = []
+    with Pool(workers) as pool:
+        for start in range(0, len(jobs), shard_size):
+            chunk = jobs[start:start + shard_size]
+            s = len(shards)
+            paths = {'images': 'images_%03d.npy' % s, 'labels': 'labels_%03d.npy' % s}
+            images = np.lib.format.open_memmap(os.path.join(out_dir, paths['images']), mode='w+',
+                        dtype=np.uint8, shape=(len(chunk), imageSize, imageSize, 3))
+            labels = np.lib.format.open_memmap(os.path.join(out_dir, paths['labels']), mode='w+',
+                        dtype=np.uint8, shape=(len(chunk), imageSize, imageSize))
+            for i, (image, label) in enumerate(pool.imap(_preprocessJob, chunk, chunksize=16)):
+                images[i] = image
+                labels[i] = label
+            images.flush()
+            labels.flush()
+            del images, labels
+            shard = {'count': len(chunk)}
+            for k, name in paths.items():
+                shard[k] = name
+                shard[k + '_sha1'] = _sha1(os.path.join(out_dir, name))
+            shards.append(shard)
+            print('[%s] %d/%d' % (dataset.type, start + len(chunk), len(jobs)))
+
+    index = {'version': CACHE_VERSION,
+             'key': cacheKey(imageSize, dataset.json_path),
+             'imageSize': imageSize,
+             'samples': dataset.relativeNames(),
+             'shards': shards}
+    _writeJson(index, os.path.join(out_dir, 'index.json'))
+    return out_dir
+
+def verifyShards(dataset, cache_root, imageSize, samples=16, workers=4):
+    '''
+        Checks the shards of a split against its source file list: the
+        sample names and counts must match, every shard must match its
+        checksum, and a random subset of samples is preprocessed again from
+        the source files and compared with the stored arrays.
+        Returns a list of problems, empty if the shards are valid.
+    '''
+    out_dir = shardDir(cache_root, dataset.type, imageSize, dataset.json_path)
+    index = loadShardIndex(out_dir)
+    if index is None:
+        return ['%s: no shard index' % out_dir]
+    errors = []
+    names = dataset.relativeNames()
+    if index['samples'] != names:
+        errors.append('sample list differs from the source file list (%d vs %d files)'
+                      % (len(index['samples']), len(names)))
+    if sum(s['count'] for s in index['shards']) != len(index['samples']):
+        errors.append('shard sizes do not add up to the number of samples')
+    arrays = []
+    for shard in index['shards']:
+        for k in ('images', 'labels'):
+            path = os.path.join(out_dir, shard[k])
+            if not os.path.exists(path) or _sha1(path) != shard[k + '_sha1']:
+                errors.append('%s: missing or checksum mismatch' % shard[k])
+        arrays.append([np.load(os.path.join(out_dir, shard[k]), mmap_mode='r')
+                       for k in ('images', 'labels')])
+    if errors:
+        return errors
+
+    key = utils.disentangleKey(dataset.classes)
+    starts = np.cumsum([0] + [s['count'] for s in index['shards']])
+    picked = np.random.permutation(len(names))[:samples]
+    jobs = [(dataset.image_list[i], dataset.gtPath(dataset.image_list[i]), imageSize, key)
+            for i in picked]
+    with Pool(workers) as pool:
+        for i, (image, label) in zip(picked, pool.imap(_preprocessJob, jobs)):
+            s = np.searchsorted(starts, i, side='right') - 1
+            images, labels = arrays[s]
+            if not (np.array_equal(images[i - starts[s]], image) and
+                    np.array_equal(labels[i - starts[s]], label)):
+                errors.append('%s: stored sample differs from the source' % names[i])
+    return errors
+
+def main():
+    from dataset.cityscapesDataLoader import cityscapesDataset
+
+    parser = argparse.ArgumentParser(description='Preprocess cityscapes into a cache')
+    parser.add_argument('--data-dir', dest='data_dir', required=True,
+                help='cityscapes root directory')
+    parser.add_argument('--json', required=True,
+                help='json file with the class definitions')
+    parser.add_argument('--imageSize', default=128, type=int,
+                help='height/width of the input image to the network')
+    parser.add_argument('--cache-dir', dest='cache_dir', required=True,
+                help='directory the cache is written to')
+    parser.add_argument('--splits', default='train,val,test',
+                help='comma separated list of splits (default: train,val,test)')
+    parser.add_argument('-j', '--workers', default=4, type=int,
+                help='number of preprocessing processes (default: 4)')
+    parser.add_argument('--shards', action='store_true',
+                help='write memory-mappable .npy shards instead of PNG files')
+    parser.add_argument('--shard-size', dest='shard_size', default=1024, type=int,
+                help='number of samples per shard (default: 1024)')
+    parser.add_argument('--verify', action='store_true',
+                help='only verify existing shards against the source files')
+    parser.add_argument('--verify-samples', dest='verify_samples', default=16, type=int,
+                help='number of samples re-encoded from source when verifying (default: 16)')
+    args = parser.parse_args()
+
+    failed = False
+    for split in args.splits.split(','):
+        dataset = cityscapesDataset(args.data_dir, split, json_path=args.json)
+        if args.verify:
+            errors = verifyShards(dataset, args.cache_dir, args.imageSize,
+                                  args.verify_samples, args.workers)
+            for e in errors:
+                print('[%s] %s' % (split, e))
+            print('[%s] shards %s' % (split, 'FAILED' if errors else 'OK'))
+            failed = failed or bool(errors)
+        elif args.shards:
+            out_dir = buildShards(dataset, args.cache_dir, args.imageSize,
+                                  args.shard_size, args.workers)
+            print('Wrote %d %s samples to %s' % (len(dataset), split, out_dir))
+        else:
+            out_dir = buildCache(dataset, args.cache_dir, args.imageSize, args.workers)
+            print('Wrote %d %s samples to %s' % (len(dataset), split, out_dir))
+    if failed:
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
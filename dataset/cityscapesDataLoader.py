@@ -9,22 +9,46 @@ import numpy as np
 from PIL import Image
 import os
 import json
+import bisect
 import cv2
 
+from dataset import cityscapesCache
+
 class cityscapesDataset(Dataset):
     '''
         cityscapes Dataset
     '''
 
-    def __init__(self, root_dir, type, transform=None, json_path=None):
+    def __init__(self, root_dir, type, transform=None, json_path=None,
+                 imageSize=None, cache_dir=None, raw=False):
         '''
         Args:
             root_dir (string): Directory with all the images
             transform(callable, optional): Optional transform to be applied
                                            on a sample
+            imageSize (int, optional): Size the images are resized to, used
+                                       to look up the preprocessed cache
+            cache_dir (string, optional): Root of the preprocessed cache
+                                          (see dataset/cityscapesCache.py).
+                                          If a valid cache exists, samples
+                                          are read from it and the
+                                          groundtruth is returned as a uint8
+                                          class index map. Shards are
+                                          preferred over PNG files; they
+                                          are memory-mapped and the image
+                                          is returned as a float tensor in
+                                          [0, 1] without applying transform.
+            raw (bool, optional): Return the image and the groundtruth as
+                                  stored, as uint8 tensors of size
+                                  [3, H, W] ([H, W] for cached class index
+                                  maps), without applying transform. Used
+                                  with dataset/batchTransforms.py.
         '''
         self.transform = transform
+        self.raw = raw
         self.root_dir = root_dir
+        self.type = type
+        self.json_path = json_path
         self.img_dir = os.path.join(root_dir, 'leftImg8bit_trainvaltest',
                                     'leftImg8bit', type)
         self.gt_dir = os.path.join(root_dir, 'gtFine_trainvaltest',
@@ -34,18 +58,107 @@ class cityscapesDataset(Dataset):
         for dir, _, files in os.walk(self.img_dir):
             for f in files:
                 self.image_list.append(os.path.join(dir, f))
+        self.image_list.sort()
 
         if json_path:
             # Read the json file containing classes information
             # This is later used to generate masks from the segmented images
             self.classes = json.load(open(json_path))['classes']
 
+        self.cache_dir = None
+        self.shard_dir = None
+        if cache_dir and imageSize and json_path:
+            self.shard_dir = self._validShards(cache_dir, imageSize)
+            if self.shard_dir is None:
+                self.cache_dir = self._validCache(cache_dir, imageSize)
+
+    def _validCache(self, cache_root, imageSize):
+        '''
+            Returns the cache directory for this split if it was built for
+            the current image size, class definitions and file list.
+        '''
+        path = cityscapesCache.cacheDir(cache_root, self.type, imageSize,
+                                        self.json_path)
+        manifest = cityscapesCache.loadManifest(path)
+        if manifest is None or manifest['samples'] != self.relativeNames():
+            print('No valid %s cache in %s, reading the original images'
+                  % (self.type, path))
+            return None
+        return path
+
+    def _validShards(self, cache_root, imageSize):
+        '''
+            Returns the shard directory for this split if its index matches
+            the current image size, class definitions and file list.
+        '''
+        path = cityscapesCache.shardDir(cache_root, self.type, imageSize,
+                                        self.json_path)
+        index = cityscapesCache.loadShardIndex(path)
+        if index is None or index['samples'] != self.relativeNames():
+            return None
+        self.shards = index['shards']
+        self.shard_starts = list(np.cumsum([0] + [s['count'] for s in self.shards])[:-1])
+        # The memory maps are opened lazily, so that every DataLoader worker
+        # maps the files itself and shares the page cache
+        self.shard_arrays = {}
+        return path
+
+    def _shardArrays(self, s):
+        if s not in self.shard_arrays:
+            self.shard_arrays[s] = [np.load(os.path.join(self.shard_dir, self.shards[s][k]),
+                                            mmap_mode='r') for k in ('images', 'labels')]
+        return self.shard_arrays[s]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if 'shard_arrays' in state:
+            state['shard_arrays'] = {}
+        return state
+
+    def sampleName(self, img_name):
+        '''
+            Sample name relative to the image directory, without the
+            'leftImg8bit.png' suffix, e.g. 'aachen/aachen_000000_000019_'
+        '''
+        return os.path.relpath(img_name, self.img_dir)[:-len('leftImg8bit.png')]
+
+    def relativeNames(self):
+        return [self.sampleName(f) for f in self.image_list]
+
+    def gtPath(self, img_name):
+        '''
+            Path of the colour groundtruth for an image
+        '''
+        return os.path.join(self.gt_dir, self.sampleName(img_name) + 'gtFine_color.png')
+
     def __len__(self):
         return len(self.image_list)
 
     def __getitem__(self, idx):
+        if self.shard_dir:
+            s = bisect.bisect_right(self.shard_starts, idx) - 1
+            images, labels = self._shardArrays(s)
+            image = images[idx - self.shard_starts[s]] # views into the memory map
+            gt = labels[idx - self.shard_starts[s]]
+            image = torch.from_numpy(np.array(image)).permute(2,0,1)
+            gt = torch.from_numpy(np.array(gt))
+            if self.raw:
+                return image, gt
+            return image.float().div(255), gt
+
         img_name = self.image_list[idx]
-        gt_name = os.path.join(self.gt_dir, img_name[90:-15] + 'gtFine_color.png')
+        if self.cache_dir:
+            name = self.sampleName(img_name)
+            image = Image.open(os.path.join(self.cache_dir, 'images', name + '.png'))
+            gt = Image.open(os.path.join(self.cache_dir, 'labels', name + '.png'))
+            gt = torch.from_numpy(np.array(gt))
+            if self.raw:
+                return torch.from_numpy(np.array(image.convert('RGB'))).permute(2,0,1), gt
+            if self.transform:
+                image = self.transform(image)
+            return image, gt
+
+        gt_name = self.gtPath(img_name)
         image = Image.open(img_name)
         image = image.convert('RGB')
         gt = Image.open(gt_name)
@@ -53,6 +166,10 @@ class cityscapesDataset(Dataset):
         #gt = cv2.imread(gt_name, cv2.cvtColor)
         #print(gt)
 
+        if self.raw:
+            return (torch.from_numpy(np.array(image)).permute(2,0,1),
+                    torch.from_numpy(np.array(gt)).permute(2,0,1))
+
         if self.transform:
             image = self.transform(image)
             gt = self.transform(gt)
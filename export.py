@@ -0,0 +1,127 @@
+'''
+Exports a CapsNet to TorchScript for inference.
+
+The network is traced at a fixed image size, routing iteration count and
+lambda, which removes the Python overhead of the routing loop. The batch size
+stays dynamic. The artifact is loaded with capsNetRuntime.py, which does not
+need the training code.
+
+Usage:
+    python export.py --net model.pth --imageSize 128 --out capsnet_128.pt --check
+'''
+
+import argparse
+import json
+import warnings
+
+import torch
+import torch.nn as nn
+
+import capsNetRuntime
+import checkpoints
+import config
+import models.matrixCapsules as capsNet
+import utils
+
+class InferenceWrapper(nn.Module):
+    '''
+        CapsNet with a fixed lambda, returning the class activations
+        [b, num_classes] and the segmentation [b, num_classes, 64, 64].
+    '''
+
+    def __init__(self, model, lambda_):
+        super(InferenceWrapper, self).__init__()
+        self.model = model
+        self.lambda_ = lambda_
+
+    def forward(self, x):
+        out, seg = self.model(x, self.lambda_)
+        nc = self.model.num_classes
+        return out.view(-1, nc*16 + nc)[:, -nc:], seg
+
+def exportModel(model, path, imageSize, lambda_=0.9, batch=2):
+    '''
+        Traces the model on a [batch, 3, imageSize, imageSize] input and
+        saves it to path together with its metadata.
+    '''
+    convcaps = [m for m in model.modules() if isinstance(m, capsNet.ConvCaps)]
+    if any(m.routing_tol for m in convcaps):
+        raise ValueError('Early stopping of the routing (routing_tol) cannot be exported')
+    model.eval()
+    device = next(model.parameters()).device
+    x = torch.rand(batch, 3, imageSize, imageSize, device=device)
+    wrapper = InferenceWrapper(model, lambda_)
+    with torch.no_grad():
+        # Settle the layers' cached state (coordinate offsets, class capsule
+        # kernel) so the traced graph is the steady state one
+        wrapper(x)
+        with warnings.catch_warnings():
+            # Sizes are constants of the trace on purpose
+            warnings.simplefilter('ignore', torch.jit.TracerWarning)
+            traced = torch.jit.trace(wrapper, x)
+    meta = {'imageSize': imageSize, 'num_classes': model.num_classes,
+            'iterations': {name: getattr(model, name).iteration for name in model.capsule_layers},
+            'lambda': lambda_}
+    torch.jit.save(traced, path, _extra_files={'metadata.json': json.dumps(meta)})
+    return meta
+
+def checkParity(model, path, lambda_=0.9, batches=(1, 3), tol=1e-5):
+    '''
+        Compares the exported network with the eager model on random inputs.
+        Returns the largest absolute difference of the outputs.
+    '''
+    module, meta = capsNetRuntime.load(path, next(model.parameters()).device)
+    wrapper = InferenceWrapper(model.eval(), lambda_)
+    worst = 0.0
+    with torch.no_grad():
+        for b in batches:
+            x = torch.rand(b, 3, meta['imageSize'], meta['imageSize'],
+                           device=next(model.parameters()).device)
+            for eager, exported in zip(wrapper(x), module(x)):
+                worst = max(worst, (eager - exported).abs().max().item())
+    print('Max difference to eager mode: %.3g (tolerance %.3g)' % (worst, tol))
+    return worst
+
+def main():
+    parser = argparse.ArgumentParser(description='Export CapsNet to TorchScript')
+    parser.add_argument('--net', default='',
+                help='path to the trained network (random weights if not set)')
+    parser.add_argument('--json', default='dataset/cityscapesClasses.json',
+                help='json file with the class definitions')
+    parser.add_argument('--imageSize', default=128, type=int,
+                help='height/width of the input image to the network')
+    parser.add_argument('--config', default='',
+                help='run config the network was trained with, if --net does not store one (see config.py)')
+    parser.add_argument('--r', type=int, default=3,
+                help='Number of Routing Iterations')
+    parser.add_argument('--lambda', dest='lambda_', default=0.9, type=float,
+                help='inverse temperature of the routing (default: 0.9)')
+    parser.add_argument('--log-routing', dest='log_routing', action='store_true',
+                help='Run the EM routing E-step in the log domain')
+    parser.add_argument('--out', default='capsnet.pt',
+                help='path of the exported network (default: capsnet.pt)')
+    parser.add_argument('--check', action='store_true',
+                help='compare the exported network with eager mode')
+    parser.add_argument('--tol', default=1e-5, type=float,
+                help='largest difference accepted by --check (default: 1e-5)')
+    args = parser.parse_args()
+
+    key = utils.disentangleKey(json.load(open(args.json))['classes'])
+    use_gpu = torch.cuda.is_available()
+    state = torch.load(args.net, map_location='cpu', weights_only=False) if args.net else None
+    run_config = config.runConfig(state, args.config)
+    model = capsNet.CapsNet(E=len(key) + 1, r=args.r, use_gpu=use_gpu,
+                            log_domain=args.log_routing,
+                            **config.capsNetKwargs(run_config, len(key) + 1, args.r))
+    if state is not None:
+        model.load_state_dict(checkpoints.modelState(state))
+    if use_gpu:
+        model.cuda()
+
+    meta = exportModel(model, args.out, args.imageSize, args.lambda_)
+    print('Exported %s: %s' % (args.out, meta))
+    if args.check and checkParity(model, args.out, args.lambda_, tol=args.tol) > args.tol:
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
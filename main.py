@@ -3,6 +3,7 @@ PyTorch implementation of Capsule Networks
 '''
 
 import argparse
+import json
 import os
 import shutil
 import time
@@ -16,6 +17,8 @@ import torch
 import torch.nn as nn
 import torch.nn.parallel
 import torch.backends.cudnn as cudnn
+import torch.distributed as dist
+import torch.multiprocessing as mp
 import torch.optim as optim
 import torch.utils.data
 import torchvision.transforms as transforms
@@ -24,11 +27,19 @@ from torch.autograd import Variable
 import torch.nn.functional as F
 from torch.optim import lr_scheduler
 
+import checkpoints
+import config
 import models.matrixCapsules as capsNet
+from dataset.batchTransforms import BatchTransform
 from dataset.cityscapesDataLoader import cityscapesDataset
+import metrics
+import profiling
 import utils
+import visualizer
 
 parser = argparse.ArgumentParser(description='PyTorch CapsNet Training')
+parser.add_argument('--config', default='', type=str,
+            help='JSON/YAML run config with the data paths, capsule stack and lambda/m schedules (see config.py)')
 parser.add_argument('-j', '--workers', default=4, type=int, metavar='N',
             help='number of data loading workers (default: 4)')
 parser.add_argument('--epochs', default=250, type=int, metavar='N',
@@ -43,6 +54,26 @@ parser.add_argument('--lr', default=0.001, type=float,
             help='learning rate (default: 0.0005)')
 parser.add_argument('--r', type=int, default=3,
             help='Number of Routing Iterations')
+parser.add_argument('--routing-tol', dest='routing_tol', default=0, type=float,
+            help='Stop routing early once R changes less than this, --r is then the maximum (default: 0, off)')
+parser.add_argument('--routing', default='detach', choices=['detach', 'last', 'full'],
+            help='Gradient flow through the routing coefficients (default: detach)')
+parser.add_argument('--vote-chunk', dest='vote_chunk', default=0, type=int,
+            help='Rows of capsule votes computed at a time without autograd (default: 0, all)')
+parser.add_argument('--routing-topk', dest='routing_topk', default=0, type=int,
+            help='After the first E-step route each capsule only to its top k capsule types (default: 0, all; '
+                 'use with --log-routing)')
+parser.add_argument('--recompute-routing', dest='recompute_routing', default='', type=str,
+            help='Comma separated capsule layers (convcaps1,convcaps2,classcaps or all) whose votes and '
+                 'routing are recomputed in the backward pass instead of stored (default: none)')
+parser.add_argument('--log-routing', dest='log_routing', action='store_true',
+            help='Run the EM routing E-step in the log domain')
+parser.add_argument('--autocast', action='store_true',
+            help='Run the forward pass under bfloat16 autocast (use with --log-routing)')
+parser.add_argument('--evaluate', action='store_true',
+            help='Only evaluate the model (see --net) on --eval-split')
+parser.add_argument('--eval-split', dest='eval_split', default='val', choices=['val', 'test'],
+            help='Split used by --evaluate (default: val)')
 parser.add_argument('--clip', default=5, type=int,
             help="Gradient Clipping")
 parser.add_argument('--net', default='',
@@ -52,6 +83,36 @@ parser.add_argument('--print-freq', '-p', default=1, type=int, metavar='N',
 parser.add_argument('--save-dir', dest='save_dir',
             default='save_temp', type=str,
             help='The directory used to save the trained models')
+parser.add_argument('--resume', default='auto', type=str,
+            help='Checkpoint to resume from; auto resumes from the latest one in --save-dir, none starts over (default: auto)')
+parser.add_argument('--keep-checkpoints', dest='keep_checkpoints', default=5, type=int, metavar='N',
+            help='Number of checkpoints kept in --save-dir (default: 5, 0 keeps all)')
+parser.add_argument('--cache-dir', dest='cache_dir', default='', type=str,
+            help='Preprocessed dataset cache (see dataset/cityscapesCache.py)')
+parser.add_argument('--device-transforms', dest='device_transforms', action='store_true',
+            help='Load uint8 batches and resize, augment and encode them on the training device')
+parser.add_argument('--max-scale', dest='max_scale', default=1.0, type=float,
+            help='With --device-transforms, zoom training images by a random factor up to this and crop (default: 1, off)')
+parser.add_argument('--flip', action='store_true',
+            help='With --device-transforms, randomly flip training images horizontally')
+parser.add_argument('--metrics-file', dest='metrics_file', default='', type=str,
+            help='Append a JSON line with the validation mIoU of every epoch to this file')
+parser.add_argument('--profile', default=0, type=int, metavar='N',
+            help='Print a step-time and memory breakdown every N steps (default: 0, off)')
+parser.add_argument('--profile-dir', dest='profile_dir', default='', type=str,
+            help='Write a JSON summary and a Chrome trace of every epoch to this directory')
+parser.add_argument('--vis-interval', dest='vis_interval', default=1, type=int, metavar='N',
+            help='Render an input | prediction | groundtruth strip every N steps (default: 1, 0 off)')
+parser.add_argument('--vis-dir', dest='vis_dir', default='', type=str,
+            help='Write the rendered strips to this directory instead of a window')
+parser.add_argument('--nproc', default=1, type=int, metavar='N',
+            help='Number of training processes on this host, gradients are all-reduced over gloo (default: 1)')
+parser.add_argument('--nnodes', default=1, type=int, metavar='N',
+            help='Number of hosts taking part in distributed training (default: 1)')
+parser.add_argument('--node-rank', dest='node_rank', default=0, type=int,
+            help='Rank of this host among --nnodes (default: 0)')
+parser.add_argument('--dist-url', dest='dist_url', default='tcp://127.0.0.1:23456', type=str,
+            help='Address of the rank 0 host used to set up distributed training')
 parser.add_argument('--verbose', default = False, type=bool,
             help='Prints certain messages which user can specify if true')
 parser.add_argument('--with_reconstruction', action='store_true', default=True,
@@ -59,13 +120,53 @@ parser.add_argument('--with_reconstruction', action='store_true', default=True,
 
 use_gpu = torch.cuda.is_available()
 
+def isMainProcess():
+    '''
+        True unless this is a distributed run and this process is not rank 0.
+    '''
+    return not dist.is_initialized() or dist.get_rank() == 0
+
 def main():
-    global args
     args = parser.parse_args()
-    print(args)
+    if 'WORLD_SIZE' in os.environ:
+        # Started by torchrun, which sets up the ranks and the rendezvous
+        worker(int(os.environ.get('LOCAL_RANK', 0)), args)
+    elif args.nproc * args.nnodes > 1:
+        mp.spawn(worker, args=(args,), nprocs=args.nproc)
+    else:
+        worker(0, args)
+
+def worker(local_rank, cli_args):
+    '''
+        Train (or evaluate) in one process. In a distributed run every
+        process trains on its shard of the data, and only rank 0 logs,
+        visualizes and saves checkpoints.
+    '''
+    global args, run_config
+    args = cli_args
+    run_config = config.loadConfig(args.config)
+
+    if 'WORLD_SIZE' in os.environ:
+        dist.init_process_group('gloo')
+    elif args.nproc * args.nnodes > 1:
+        dist.init_process_group('gloo', init_method=args.dist_url,
+                                world_size=args.nproc * args.nnodes,
+                                rank=args.node_rank * args.nproc + local_rank)
+    distributed = dist.is_initialized()
+    if distributed:
+        if use_gpu:
+            torch.cuda.set_device(local_rank % torch.cuda.device_count())
+        else:
+            # Share the cores of the host between its processes
+            torch.set_num_threads(max(1, (os.cpu_count() or 1) // args.nproc))
+    main_process = isMainProcess()
+
+    if main_process:
+        print(args)
+        print(run_config)
 
     # Check if the save directory exists or not
-    if not os.path.exists(args.save_dir):
+    if main_process and not os.path.exists(args.save_dir):
         os.makedirs(args.save_dir)
 
     cudnn.benchmark = True
@@ -87,17 +188,29 @@ def main():
     }
 
     # Data Loading
-    data_dir = '/media/salman/DATA/General Datasets/cityscapes'
+    data_dir = run_config['data']['data_dir']
     # json path for class definitions
-    json_path = '/home/salman/pytorch/capsNet/dataset/cityscapesClasses.json'
+    json_path = run_config['data']['json_path']
 
     image_datasets = {x: cityscapesDataset(data_dir, x, data_transforms[x],
-                    json_path) for x in ['train', 'val', 'test']}
+                    json_path, args.imageSize, args.cache_dir, args.device_transforms)
+                    for x in ['train', 'val', 'test']}
+
+    # Each process loads its own shard of every split. The evaluation splits
+    # are strided without DistributedSampler's padding, so every sample is
+    # counted exactly once in the all-reduced confusion matrix
+    samplers = {x: None for x in ['train', 'val', 'test']}
+    if distributed:
+        samplers['train'] = torch.utils.data.distributed.DistributedSampler(image_datasets['train'])
+        for x in ['val', 'test']:
+            samplers[x] = range(dist.get_rank(), len(image_datasets[x]), dist.get_world_size())
 
     dataloaders = {x: torch.utils.data.DataLoader(image_datasets[x],
                                                   batch_size=args.batchSize,
-                                                  shuffle=True,
-                                                  num_workers=args.workers)
+                                                  shuffle=samplers[x] is None,
+                                                  sampler=samplers[x],
+                                                  num_workers=args.workers,
+                                                  pin_memory=use_gpu and args.device_transforms)
                   for x in ['train', 'val', 'test']}
     dataset_sizes = {x: len(image_datasets[x]) for x in ['train', 'val', 'test']}
 
@@ -107,60 +220,167 @@ def main():
     num_classes = len(key) + 1
     # +1 for the background class. The +1 is dataset dependant, since some
     # datasets have an intrinsic background class
-
-    lambda_ = 1e-3
-    m = 0.2
-    A,B,C,D,E,r = 32,32,32,32,num_classes,args.r
+    names = {int(c['id']): c['name'] for c in classes}
+    class_names = [names.get(k, str(k)) for k in range(len(key))] + ['background']
+
+    # Batched transforms on the training device, in place of data_transforms
+    batch_transforms = {x: None for x in ['train', 'val', 'test']}
+    if args.device_transforms:
+        device = 'cuda' if use_gpu else None
+        batch_transforms = {
+            'train': BatchTransform(args.imageSize, key, device, args.max_scale, args.flip),
+            'val': BatchTransform(args.imageSize, key, device),
+            'test': BatchTransform(args.imageSize, key, device),
+        }
+
+    schedule = run_config['schedule']
+    lambda_ = schedule['lambda']['start']
+    m = schedule['m']['start']
+
+    recompute = [l for l in args.recompute_routing.split(',') if l]
+    if 'all' in recompute:
+        recompute = config.layerNames(run_config)
 
     # Initialize the Network
-    model = capsNet.CapsNet(A,B,C,D,E,r,use_gpu)
+    model = capsNet.CapsNet(E=num_classes, r=args.r, use_gpu=use_gpu, routing=args.routing, vote_chunk=args.vote_chunk,
+                            log_domain=args.log_routing, routing_tol=args.routing_tol,
+                            checkpoint=recompute, routing_topk=args.routing_topk,
+                            **config.capsNetKwargs(run_config, num_classes, args.r))
 
     if use_gpu:
         model.cuda()
 
-    print('The Matrix Capsules Network')
-    print(model)
+    if main_process:
+        print('The Matrix Capsules Network')
+        print(model)
+        print(model.costSummary(args.imageSize, args.batchSize))
 
     if args.net:
-        model.load_state_dict(torch.load(args.net))
-        m = 0.8
-        lambda_ = 0.9
+        state = torch.load(args.net, map_location='cpu', weights_only=False)
+        model.load_state_dict(checkpoints.modelState(state))
+        m = schedule['m']['pretrained']
+        lambda_ = schedule['lambda']['pretrained']
 
     # Define the optimizer
     optimizer = optim.Adam(model.parameters(), lr=args.lr)
     scheduler = lr_scheduler.ReduceLROnPlateau(optimizer, 'max',patience = 1)
 
+    # Resume the training state
+    start_epoch, step = args.start_epoch, 0
+    resume = args.resume
+    if resume == 'auto':
+        resume = checkpoints.latestCheckpoint(args.save_dir)
+    elif resume == 'none':
+        resume = None
+    checkpoint = None
+    if resume and main_process:
+        checkpoint = torch.load(resume, map_location='cpu', weights_only=False)
+    if distributed:
+        # Only rank 0 writes checkpoints, the other hosts may not have them,
+        # so every process resumes from rank 0's state
+        shared = [checkpoint]
+        dist.broadcast_object_list(shared, src=0)
+        checkpoint = shared[0]
+    if checkpoint is not None:
+        model.load_state_dict(checkpoint['model'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        scheduler.load_state_dict(checkpoint['scheduler'])
+        start_epoch, step = checkpoint['epoch'] + 1, checkpoint['step']
+        lambda_, m = checkpoint['lambda_'], checkpoint['m']
+        checkpoints.setRngState(checkpoint['rng'])
+        if main_process:
+            print('Resumed from %s (epoch %d, step %d)' % (resume, checkpoint['epoch'], step))
+
+    if distributed:
+        # Gradients are averaged over the processes in backward
+        model = nn.parallel.DistributedDataParallel(model)
+
     # Initialize the loss function
     # loss_fn = capsNet.MarginLoss(0.9, 0.1, 0.5)
 
-    for epoch in range(args.start_epoch, args.epochs):
+    if args.evaluate:
+        validate(dataloaders[args.eval_split], model, key, lambda_, num_classes, class_names,
+                 batch_transforms[args.eval_split])
+        return
+
+    if main_process and (args.profile or args.profile_dir):
+        profiling.enable(profiling.StepProfiler(args.profile, args.profile_dir or None))
+
+    vis = visualizer.SampleVisualizer(key, args.vis_interval if main_process else 0,
+                                      args.vis_dir or None)
+    saver = checkpoints.CheckpointSaver(args.save_dir, args.keep_checkpoints) if main_process else None
+
+    for epoch in range(start_epoch, args.epochs):
+        epoch_start = time.time()
+        if distributed:
+            samplers['train'].set_epoch(epoch)
 
         # Train for one epoch
-        train(dataloaders['train'], model, optimizer, epoch, key, lambda_,
-                m, num_classes)
+        lambda_, m = train(dataloaders['train'], model, optimizer, epoch, key, lambda_,
+                m, num_classes, vis, batch_transforms['train'])
+        step += len(dataloaders['train'])
 
-        # Save checkpoints
-        #torch.save(net.state_dict(), '%s/net_epoch_%d.pth' % (args.save_dir, epoch))
+        if profiling.active():
+            profiling.active().dumpEpoch(epoch)
+
+        # Evaluate on the validation set
+        mIoU = validate(dataloaders['val'], model, key, lambda_, num_classes, class_names,
+                        batch_transforms['val'])
+        scheduler.step(mIoU)
 
-def train(train_loader, model, optimizer, epoch, key, lambda_, m, nc):
+        if main_process and args.metrics_file:
+            with open(args.metrics_file, 'a') as f:
+                f.write(json.dumps({'epoch': epoch, 'mIoU': mIoU, 'lambda_': lambda_, 'm': m,
+                                    'seconds': time.time() - epoch_start}) + '\n')
+
+        # Save checkpoints
+        if saver is not None:
+            net = model.module if distributed else model
+            saver.save({'model': net.state_dict(), 'optimizer': optimizer.state_dict(),
+                        'scheduler': scheduler.state_dict(), 'epoch': epoch, 'step': step,
+                        'lambda_': lambda_, 'm': m, 'rng': checkpoints.rngState(),
+                        'config': run_config}, epoch)
+
+    if saver is not None:
+        saver.close()
+    vis.close()
+    if distributed:
+        dist.destroy_process_group()
+
+def train(train_loader, model, optimizer, epoch, key, lambda_, m, nc, vis, batch_transform=None):
     '''
         Run one training epoch
     '''
     model.train()
+    net = getattr(model, 'module', model) # the CapsNet inside DistributedDataParallel
     b = 0
     steps = len(train_loader)//args.batchSize
+    end = time.time()
     for i, (img, gt) in enumerate(train_loader):
+        profiling.record('data', time.time() - end)
+
+        if batch_transform is not None:
+            with profiling.section('transform'):
+                img, gt = batch_transform(img, gt)
 
         # Generate the class-wise probability vector
-        gt_temp = gt * 255
-        labels = utils.generatePresenceVector(gt_temp, key).float()
-        oneHotGT = utils.generateOneHot(gt_temp, key).float()
+        with profiling.section('labels'):
+            if gt.dim() == 3:
+                # Class index maps from the preprocessed cache
+                gtIndex = gt.cuda() if use_gpu else gt
+                gt = utils.indexToColor(gtIndex, key).permute(0,3,1,2).float() / 255
+            else:
+                gt_temp = gt * 255
+                gtIndex = utils.encodeLabels(gt_temp, key, 'cuda' if use_gpu else None)
+            labels = utils.indexToPresence(gtIndex, nc, torch.float32)
+            oneHotGT = utils.indexToOneHot(gtIndex, nc, torch.float32)
 
         b += 1
-        if lambda_ < 1:
-            lambda_ += 2e-1/steps
-        if m < 0.9:
-            m += 2e-1/steps
+        schedule = run_config['schedule']
+        if lambda_ < schedule['lambda']['max']:
+            lambda_ += schedule['lambda']['increment']/steps
+        if m < schedule['m']['max']:
+            m += schedule['m']['increment']/steps
 
         optimizer.zero_grad()
         img, labels= Variable(img, requires_grad=True), Variable(labels),
@@ -172,12 +392,19 @@ def train(train_loader, model, optimizer, epoch, key, lambda_, m, nc):
             gt = gt.cuda()
             oneHotGT = oneHotGT.cuda()
 
-        out, seg = model(img, lambda_)
+        with profiling.section('forward'), torch.autocast('cuda' if use_gpu else 'cpu',
+                dtype=torch.bfloat16, enabled=args.autocast):
+            out, seg = model(img, lambda_)
+        out, seg = out.float(), seg.float()
+        # The segmentation output has a fixed size, scale it to the labels
+        if seg.shape[-2:] != oneHotGT.shape[-2:]:
+            seg = F.interpolate(seg, size=oneHotGT.shape[-2:], mode='bilinear',
+                                align_corners=False)
         outForLoss = out.view(-1, nc*16 + nc) #b,10*16+10
         out_poses, out_labels = outForLoss[:,:-nc],outForLoss[:,-nc:]
 
         #loss = model.loss(out_labels, labels, m, nc)
-        classLoss = model.classLoss(out_labels, labels)
+        classLoss = net.classLoss(out_labels, labels)
 
         torch.nn.utils.clip_grad_norm(model.parameters(), args.clip)
 
@@ -187,14 +414,25 @@ def train(train_loader, model, optimizer, epoch, key, lambda_, m, nc):
 
         loss = classLoss + 10 * segLoss
 
-        loss.backward()
-        optimizer.step()
+        with profiling.section('backward'):
+            loss.backward()
+        with profiling.section('optimizer'):
+            optimizer.step()
 
-        print('[%d/%d][%d/%d] Class Loss: %.4f | Segmentation Loss: %.4f | Total Loss: %.4f'
-              % (epoch, args.epochs, i, len(train_loader), classLoss.mean().data[0],
-                 segLoss.mean().data[0], loss.mean().data[0]))
+        if isMainProcess():
+            print('[%d/%d][%d/%d] Class Loss: %.4f | Segmentation Loss: %.4f | Total Loss: %.4f'
+                  % (epoch, args.epochs, i, len(train_loader), classLoss.mean().item(),
+                     segLoss.mean().item(), loss.mean().item()))
+            print('    Routing iterations (last delta R): ' + ' | '.join(
+                  '%s %d (%.2e)' % stat for stat in net.routingStats()))
 
-        utils.displaySamples(img, seg, gt, use_gpu, key)
+        with profiling.section('display'):
+            vis.submit(epoch * len(train_loader) + i, img, seg, gt)
+
+        profiling.step()
+        end = time.time()
+
+    return lambda_, m
 
         # # Generate the target vector from the groundtruth image
         # # Multiplication by 255 to convert from float to unit8
@@ -236,5 +474,45 @@ def train(train_loader, model, optimizer, epoch, key, lambda_, m, nc):
         # #            normalize=True)
         #     utils.displaySamples(data, output, target, use_gpu, key)
 
+def validate(val_loader, model, key, lambda_, nc, class_names=None, batch_transform=None):
+    '''
+        Evaluate the segmentation output on a split.
+        Returns the mean IoU over the classes.
+    '''
+    # The shards may differ in length, so skip DistributedDataParallel's
+    # forward synchronisation
+    model = getattr(model, 'module', model)
+    model.eval()
+    confusion = metrics.ConfusionMatrix(nc, device='cuda' if use_gpu else None)
+    with torch.no_grad():
+        for i, (img, gt) in enumerate(val_loader):
+            if batch_transform is not None:
+                img, gt = batch_transform(img, gt)
+            if use_gpu:
+                img, gt = img.cuda(), gt.cuda()
+            if gt.dim() == 3:
+                gtIndex = gt
+            else:
+                gtIndex = utils.encodeLabels(gt * 255, key)
+
+            with torch.autocast('cuda' if use_gpu else 'cpu',
+                    dtype=torch.bfloat16, enabled=args.autocast):
+                _, seg = model(img, lambda_)
+            # The segmentation output has a fixed size, scale it to the labels
+            seg = F.interpolate(seg.float(), size=gtIndex.shape[-2:], mode='bilinear',
+                                align_corners=False)
+            confusion.update(seg.argmax(1), gtIndex)
+
+            if i % args.print_freq == 0 and isMainProcess():
+                print('[Eval][%d/%d] Pixel accuracy: %.4f | mIoU: %.4f'
+                      % (i, len(val_loader), confusion.pixelAccuracy(), confusion.meanIoU()))
+
+    if dist.is_initialized():
+        # Every process evaluated its shard of the split
+        dist.all_reduce(confusion.matrix)
+    if isMainProcess():
+        print(confusion.summary(class_names))
+    return confusion.meanIoU()
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,64 @@
+'''
+Segmentation metrics accumulated over an evaluation run.
+'''
+
+import torch
+
+import utils
+
+class ConfusionMatrix(object):
+    '''
+        Per-class confusion matrix accumulated batch by batch on the device
+        of the predictions, so predictions never have to be kept around.
+        Rows are the groundtruth classes, columns the predicted classes.
+        Pixels labelled ignore_index are not counted.
+    '''
+
+    def __init__(self, num_classes, ignore_index=utils.IGNORE_INDEX, device=None):
+        self.num_classes = num_classes
+        self.ignore_index = ignore_index
+        self.matrix = torch.zeros(num_classes, num_classes, dtype=torch.long, device=device)
+
+    def reset(self):
+        self.matrix.zero_()
+
+    def update(self, pred, target):
+        '''
+            Adds a batch of predicted and groundtruth class index maps of the
+            same size [batchSize, H, W].
+        '''
+        nc = self.num_classes
+        pred, target = pred.reshape(-1).long(), target.reshape(-1).long()
+        valid = target != self.ignore_index
+        idx = target[valid] * nc + pred[valid]
+        self.matrix += torch.bincount(idx, minlength=nc * nc).view(nc, nc).to(self.matrix.device)
+
+    def pixelAccuracy(self):
+        total = self.matrix.sum()
+        return (self.matrix.diag().sum().double() / total.clamp(min=1)).item()
+
+    def classIoU(self):
+        '''
+            IoU of every class as a double tensor; nan for classes which
+            appear neither in the groundtruth nor in the predictions.
+        '''
+        m = self.matrix.double()
+        union = m.sum(0) + m.sum(1) - m.diag()
+        iou = m.diag() / union
+        return iou.masked_fill(union == 0, float('nan')).cpu()
+
+    def meanIoU(self):
+        iou = self.classIoU()
+        iou = iou[~torch.isnan(iou)]
+        return iou.mean().item() if iou.numel() else 0.0
+
+    def summary(self, names=None):
+        '''
+            Table of the per-class IoU followed by the pixel accuracy and mIoU.
+        '''
+        lines = ['    %-20s %8s' % ('class', 'IoU')]
+        for k, iou in enumerate(self.classIoU().tolist()):
+            name = names[k] if names is not None else str(k)
+            lines.append('    %-20s %8.4f' % (name, iou))
+        lines.append('Pixel accuracy: %.4f | mIoU: %.4f' % (self.pixelAccuracy(), self.meanIoU()))
+        return '\n'.join(lines)
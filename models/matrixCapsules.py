@@ -8,16 +8,18 @@ Code adapted from: https://github.com/shzygmyx/Matrix-Capsules-pytorch
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import numpy as np
+import torch.utils.checkpoint
 import math
-from torch.autograd import Variable
+
+import profiling
 
 verbose = False
 
 class PrimaryCaps(nn.Module):
     """
     Primary Capsule layer is nothing more than concatenate several convolutional
-    layer together.
+    layer together. All the capsule types are computed by one convolution with
+    B*16 pose channels followed by B activation channels.
     Args:
         A:input channel
         B:number of types of capsules.
@@ -26,21 +28,26 @@ class PrimaryCaps(nn.Module):
     def __init__(self,A=32, B=32):
         super(PrimaryCaps, self).__init__()
         self.B = B
-        self.capsules_pose = nn.ModuleList([nn.Conv2d(in_channels=A,out_channels=4*4,
-                                                 kernel_size=1,stride=1)
-                                                 for i in range(self.B)])
-        self.capsules_activation = nn.ModuleList([nn.Conv2d(in_channels=A,out_channels=1,
-                                                 kernel_size=1,stride=1) for i
-                                                 in range(self.B)])
+        self.capsules = nn.Conv2d(in_channels=A,out_channels=(4*4+1)*self.B,
+                                  kernel_size=1,stride=1)
 
     def forward(self, x): #b,14,14,32
-        poses = [self.capsules_pose[i](x) for i in range(self.B)]#(b,16,12,12) *32
-        poses = torch.cat(poses, dim=1) #b,16*32,12,12
-        activations = [self.capsules_activation[i](x) for i in range(self.B)] #(b,1,12,12)*32
-        activations = F.sigmoid(torch.cat(activations, dim=1)) #b,32,12,12
+        x = self.capsules(x) #b,17*32,12,12
+        poses = x[:,:-self.B] #b,16*32,12,12
+        activations = F.sigmoid(x[:,-self.B:]) #b,32,12,12
         output = torch.cat([poses, activations], dim=1)
         return output
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints saved before the convolutions were fused hold one
+        # Conv2d per capsule type, capsules_pose.i and capsules_activation.i
+        if prefix + 'capsules_pose.0.weight' in state_dict:
+            for param in ('weight', 'bias'):
+                fused = [state_dict.pop('%scapsules_%s.%d.%s' % (prefix, kind, i, param))
+                         for kind in ('pose', 'activation') for i in range(self.B)]
+                state_dict[prefix + 'capsules.' + param] = torch.cat(fused, 0)
+        super(PrimaryCaps, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
 class ConvCaps(nn.Module):
     """
     Convolutional Capsule Layer.
@@ -54,10 +61,35 @@ class ConvCaps(nn.Module):
         iteration: number of EM iterations
         coordinate_add: whether to use Coordinate Addition
         transform_share: whether to share transformation matrix.
+        routing: how the routing coefficients R take part in autograd.
+        'detach' keeps R out of the graph and only builds the graph for the
+        final M-step, 'last' also keeps the last E-step (and the M-step it
+        depends on) in the graph, 'full' backpropagates through every iteration.
+        vote_chunk: number of rows of output positions the votes are computed
+        for at a time, to cap peak memory when running without autograd.
+        0 computes all of them at once.
+        log_domain: run the E-step on log-likelihoods and normalise R with a
+        log-sum-exp over the capsules each capsule i is connected to, so that
+        the product over the 16 pose components cannot underflow. Needed for
+        float16/bfloat16. The layer runs in the dtype of its input (e.g. the
+        bfloat16 autocast gives the convolutions), parameters are cast to it.
+        routing_tol: stop routing once the largest change of R in an E-step
+        is below this tolerance, iteration is then the maximum number of
+        iterations. 0 always runs iteration iterations. After every forward,
+        iterations_run and final_delta (the last change of R) record what
+        the routing did.
+        checkpoint: do not keep the votes and the routing intermediates for
+        the backward pass but recompute them from the layer input, trading
+        one more forward pass of the layer for its activation memory.
+        topk: after the first E-step, keep only the topk capsule types c each
+        capsule i is most assigned to at every output position, and run the
+        later M- and E-steps on those pairs only. 0 (or topk >= C) routes
+        to all C types.
 
     """
     def __init__(self, B=32, C=32, kernel = 3, stride=2,iteration=3, use_gpu=True,
-                 coordinate_add=False, transform_share = False):
+                 coordinate_add=False, transform_share = False, routing='detach',
+                 vote_chunk=0, log_domain=False, routing_tol=0, checkpoint=False, topk=0):
         super(ConvCaps, self).__init__()
         self.B =B
         self.C=C
@@ -74,147 +106,342 @@ class ConvCaps(nn.Module):
             self.W = nn.Parameter(torch.randn(self.B, self.C, 4, 4)) #B,C,4,4
         self.iteration=iteration
         self.use_gpu = use_gpu
+        if routing not in ('detach', 'last', 'full'):
+            raise ValueError('Unknown routing mode: %s' % routing)
+        self.routing = routing
+        self.vote_chunk = vote_chunk
+        self.log_domain = log_domain
+        self.routing_tol = routing_tol
+        self.checkpoint = checkpoint
+        self.topk = topk
+        self.iterations_run = 0
+        self.final_delta = None
+        #scaled coordinates of every vote, built for (width_in, K, stride)
+        self.register_buffer('coord_add', torch.zeros(0), persistent=False)
+        self._coord_key = None
 
-    def forward(self, x, lambda_):
-#        t = time()
-        b = x.size(0) #batchsize
-        width_in = x.size(2)  #12
-        pose = x[:,:-self.B,:,:].contiguous() #b,16*32,12,12
-        pose = pose.view(b,16,self.B,width_in,width_in).permute(0,2,3,4,1).contiguous() #b,B,12,12,16
-        activation = x[:,-self.B:,:,:] #b,B,12,12
-        w = width_out = int((width_in-self.K)/self.stride+1) if self.K else 1 #5
+    def _votes(self, poses, w):
+        """
+        Multiplies the poses in every receptive field by the transformation
+        matrices, as one batched matmul per chunk of self.vote_chunk rows of
+        the w,w grid (all rows at once if vote_chunk is 0). Chunking is only
+        used with autograd disabled: when training, the backward pass of the
+        chunked writes costs more than the memory it saves.
+        """
         if self.transform_share:
-            if self.K == 0:
-                self.K = width_in # class Capsules' kernel = width_in
-            W = self.W.view(self.B,1,1,self.C,4,4).expand(self.B,self.K,self.K,self.C,4,4).contiguous()
+            eq = 'ncpq,bnklijqr->bnklcijpr' # W: B,C,4,4, shared over K,K
         else:
-            W = self.W #B,K,K,C,4,4
-
-        #used to store every capsule i's poses in each capsule c's receptive field
-        poses = torch.stack([pose[:,:,self.stride*i:self.stride*i+self.K,
-                       self.stride*j:self.stride*j+self.K,:] for i in range(w) for j in range(w)], dim=-1) #b,B,K,K,w*w,16
-        poses = poses.view(b,self.B,self.K,self.K,1,w,w,4,4) #b,B,K,K,1,w,w,4,4
-        W_hat = W[None,:,:,:,:,None,None,:,:]                #1,B,K,K,C,1,1,4,4
-        votes = torch.matmul(W_hat, poses) #b,B,K,K,C,w,w,4,4
-
-        #Coordinate Addition
-        add = [] #K,K,w,w
-        if self.coordinate_add:
-            for i in range(self.K):
-                for j in range(self.K):
-                    for x in range(w):
-                        for y in range(w):
-                            #compute where is the V_ic
-                            pos_x = self.stride*x + i
-                            pos_y = self.stride*y + j
-                            add.append([pos_x/width_in, pos_y/width_in])
-            add = Variable(torch.Tensor(add)).view(1,1,self.K,self.K,1,w,w,2)
-            add = add.expand(b,self.B,self.K,self.K,self.C,w,w,2).contiguous()
-            if self.use_gpu:
-                add = add.cuda()
-            votes[:,:,:,:,:,:,:,0,:2] = votes[:,:,:,:,:,:,:,0,:2] + add
-
-#        print(time()-t)
-        #Start EM
+            eq = 'nklcpq,bnklijqr->bnklcijpr' # W: B,K,K,C,4,4
+        if not self.vote_chunk or self.vote_chunk >= w or torch.is_grad_enabled():
+            return torch.einsum(eq, self.W.to(poses.dtype), poses).contiguous()
+        b, B, K = poses.size(0), poses.size(1), poses.size(2)
+        votes = poses.new_empty(b,B,K,K,self.C,w,w,4,4)
+        for i in range(0, w, self.vote_chunk):
+            votes[:,:,:,:,:,i:i+self.vote_chunk] = torch.einsum(
+                eq, self.W.to(poses.dtype), poses[:,:,:,:,i:i+self.vote_chunk])
+        return votes
+
+    def _coordinate_offsets(self, width_in, w, votes):
+        """
+        Scaled coordinates (pos_x/width_in, pos_y/width_in) of the capsule
+        each vote comes from, shaped 1,1,K,K,1,w,w,2 to broadcast over the
+        first pose row of the votes. Only rebuilt when width_in, K or the
+        stride change.
+        """
+        key = (width_in, self.K, self.stride)
+        if self._coord_key != key:
+            pos = torch.arange(w).view(1,w)*self.stride + torch.arange(self.K).view(self.K,1) #K,w
+            pos = pos.double()/width_in
+            add = torch.stack([pos.view(self.K,1,w,1).expand(self.K,self.K,w,w),
+                               pos.view(1,self.K,1,w).expand(self.K,self.K,w,w)], -1) #K,K,w,w,2
+            self.coord_add = add.view(1,1,self.K,self.K,1,w,w,2).to(votes.device, votes.dtype)
+            self._coord_key = key
+        if self.coord_add.device != votes.device or self.coord_add.dtype != votes.dtype:
+            self.coord_add = self.coord_add.to(votes.device, votes.dtype)
+        return self.coord_add
+
+    def _log_normalize(self, log_p_hat, width_in, w):
+        """
+        Turns log(a_c*p_c(V_ic)) of size b,Bkk,n,w*w (n capsules c per
+        receptive field entry, C or topk) into log R by subtracting the
+        log-sum-exp over every capsule c each capsule i is connected to.
+        The receptive fields are scattered onto the input positions with a
+        per-position max shift, so no term underflows.
+        """
+        b, n = log_p_hat.size(0), log_p_hat.size(2)
+        #input position (stride*x+k_x)*width_in + stride*y+k_y of every receptive field entry
+        k = torch.arange(self.K, device=log_p_hat.device)
+        x = torch.arange(w, device=log_p_hat.device)*self.stride
+        pos = (k.view(self.K,1,1,1) + x.view(1,1,w,1))*width_in + k.view(1,self.K,1,1) + x.view(1,1,1,w)
+        pos = pos.view(1,1,-1).expand(b,self.B,-1) #b,B,K*K*w*w
+
+        log_p_hat = log_p_hat.view(b,self.B,self.K*self.K,n,w*w)
+        shift = log_p_hat.detach().amax(3).view(b,self.B,-1) #b,B,K*K*w*w
+        shift = log_p_hat.new_full((b,self.B,width_in*width_in), -float('inf')).scatter_reduce(
+            2, pos, shift, 'amax').gather(2, pos).view(b,self.B,self.K*self.K,1,w*w)
+        sum_p_hat = torch.exp(log_p_hat - shift).sum(3).view(b,self.B,-1) #b,B,K*K*w*w
+        sum_p_hat = sum_p_hat.new_zeros((b,self.B,width_in*width_in)).scatter_add(
+            2, pos, sum_p_hat).gather(2, pos).view(b,self.B,self.K*self.K,1,w*w)
+        return log_p_hat - shift - torch.log(sum_p_hat)
+
+    def _m_step(self, R, a_s, V_s, lambda_, w):
+        """
+        M-step: the mean, variance and activation of every capsule c from the
+        votes V_s (b,Bkk,Cww,16) weighted by R*a_s (b,Bkk,Cww).
+        """
+        b, Bkk, Cww = R.shape
+        r_hat = R*a_s #b,Bkk,Cww
+        r_hat = r_hat.clamp(0.01) #prevent nan since we'll devide sth. by r_hat
+        sum_r_hat = r_hat.sum(1).view(b,1,Cww,1).expand(b,1,Cww,16) #b,Cww,16
+        r_hat_stack = r_hat.view(b,Bkk,Cww,1).expand(b, Bkk, Cww,16) #b,Bkk,Cww,16
+        mu = torch.sum(r_hat_stack*V_s, 1, True)/sum_r_hat #b,1,Cww,16
+        mu_stack = mu.expand(b,Bkk,Cww,16) #b,Bkk,Cww,16
+        sigma = torch.sum(r_hat_stack*(V_s-mu_stack)**2,1,True)/sum_r_hat #b,1,Cww,16
+        sigma = sigma.clamp(0.01) #prevent nan since the following is a log(sigma)
+        return mu, sigma, self._logits(sigma, sum_r_hat, lambda_, w)
+
+    def _m_step_sparse(self, R, a_s, V_s, idx, lambda_, w):
+        """
+        M-step over the top-k pairs only: R, a_s (b,Bkk,k,ww) and V_s
+        (b,Bkk,k,ww,16) of every capsule i and the types idx (b,Bkk,k,ww) of
+        the capsules c they are assigned to. Returns the same as _m_step.
+        A capsule c no capsule i kept has no votes and gets activation 0
+        (logit -inf): unlike the dense M-step, where the r_hat floor gives
+        every pair some assignment, its cost would otherwise be 0 and its
+        activation sigmoid(lambda_*beta_a) regardless of the input.
+        """
+        b, Bkk, k, ww = R.shape
+        r_hat = (R*a_s).clamp(0.01) #b,Bkk,k,ww
+        index = idx.view(b,Bkk*k,ww)
+        index16 = index.unsqueeze(3).expand(b,Bkk*k,ww,16)
+        #sums over the capsules i assigned to each capsule c
+        sum_r_hat = r_hat.new_zeros(b,self.C,ww).scatter_add(1, index, r_hat.view(b,Bkk*k,ww))
+        sum_r_hat = sum_r_hat.view(b,self.C,ww,1).expand(b,self.C,ww,16) #b,C,ww,16
+        #types nobody is assigned to get mu = 0, sigma = 0.01 and activation 0
+        denom = sum_r_hat.clamp(min=1e-6)
+        r_hat = r_hat.view(b,Bkk*k,ww,1)
+        V_s = V_s.view(b,Bkk*k,ww,16)
+        mu = V_s.new_zeros(b,self.C,ww,16).scatter_add(1, index16, r_hat*V_s)/denom #b,C,ww,16
+        sigma = V_s.new_zeros(b,self.C,ww,16).scatter_add(
+            1, index16, r_hat*(V_s-mu.gather(1, index16))**2)/denom #b,C,ww,16
+        sigma = sigma.clamp(0.01)
+        mu, sigma = mu.view(b,1,self.C*ww,16), sigma.view(b,1,self.C*ww,16)
+        sum_r_hat = sum_r_hat.reshape(b,1,self.C*ww,16)
+        logit_c = self._logits(sigma, sum_r_hat, lambda_, w)
+        return mu, sigma, logit_c.masked_fill(sum_r_hat[...,0] == 0, float('-inf'))
+
+    def _logits(self, sigma, sum_r_hat, lambda_, w):
+        """
+        Activation logits (b,1,Cww) of the capsules c from their variance and
+        the total assignment to them (b,1,Cww,16).
+        """
+        b = sigma.size(0)
+        cost = (self.beta_v.to(sigma.dtype) + torch.log(sigma)) * sum_r_hat #b,1,Cww,16
+        beta_a_stack = self.beta_a.to(cost.dtype).view(1,self.C,1).expand(b,self.C,w*w).contiguous().view(b,1,-1)#b,Cww
+        return lambda_*(beta_a_stack-torch.sum(cost,3)) #b,1,Cww
+
+    def _e_step(self, V_e, mu, sigma, logit_c, width_in, w):
+        """
+        E-step: the new assignment R (b,Bkk,n,ww) of every capsule i to the
+        n capsules c (all C types, or its top-k) whose receptive field
+        contains it. V_e is b,Bkk,n,ww,16, mu and sigma are the matching
+        parameters of the capsules c (b,1,n,ww,16 or b,Bkk,n,ww,16) and
+        logit_c their activation logits (b,1,n,ww or b,Bkk,n,ww).
+        """
+        b, Bkk, n, ww = V_e.shape[:4]
+        if self.log_domain:
+            log_p = -(V_e-mu)**2 - 0.5*torch.log(2*math.pi*sigma) #b,Bkk,n,ww,16
+            log_p = torch.sum(log_p, 4, dtype=torch.float32) #b,Bkk,n,ww
+            log_p_hat = F.logsigmoid(logit_c.float()) + log_p #b,Bkk,n,ww
+            log_R = self._log_normalize(log_p_hat, width_in, w)
+            return torch.exp(log_R).to(V_e.dtype).view(b,Bkk,n,ww) #b,Bkk,n,ww
+        p = torch.exp(-(V_e-mu)**2)/torch.sqrt(2*math.pi*sigma) #b,Bkk,n,ww,16
+        p = p.prod(dim=4) #b,Bkk,n,ww
+        p_hat = torch.sigmoid(logit_c)*p #b,Bkk,n,ww
+        #sum over every capsule c each capsule i is connected to: sum
+        #over n, then scatter-add the receptive fields back onto the input
+        sum_p_hat = F.fold(p_hat.sum(2), (width_in,width_in), self.K,
+                           stride=self.stride) #b,B,12,12
+        sum_p_hat = F.unfold(sum_p_hat, self.K, stride=self.stride) #b,Bkk,w*w
+        return p_hat/sum_p_hat.view(b,Bkk,1,ww) #b,Bkk,n,ww
+
+    def _sparsify(self, R, V_s, V_e, a_s, w):
+        """
+        Keeps the topk capsules c (among the C types) each capsule i is most
+        assigned to at every output position. Returns R, V_s, V_e and a_s
+        restricted to those pairs (b,Bkk,k,ww[,16]) and the types idx
+        (b,Bkk,k,ww) of the kept capsules c.
+        """
+        b, Bkk = R.shape[:2]
+        R, idx = R.view(b,Bkk,self.C,w*w).topk(self.topk, 2) #b,Bkk,k,ww
+        idx16 = idx.unsqueeze(4).expand(b,Bkk,self.topk,w*w,16)
+        V_s = V_s.view(b,Bkk,self.C,w*w,16).gather(2, idx16)
+        V_e = V_e.view(b,Bkk,self.C,w*w,16).gather(2, idx16)
+        a_s = a_s.view(b,Bkk,self.C,w*w)[:,:,:self.topk] #the same for every c
+        return R, V_s, V_e, a_s, idx
+
+    def _route(self, votes, activation, lambda_, width_in, w):
+        """
+        EM routing of the votes (b,B,K,K,C,w,w,4,4) of the capsules with the
+        given activations (b,B,width_in,width_in).
+        Returns the poses (b,C,w,w,16) and activations (b,C,w,w) of the
+        capsules c.
+        """
+        b = votes.size(0)
         Cww = w*w*self.C
         Bkk = self.K*self.K*self.B
-        R = np.ones([b,self.B,width_in,width_in,self.C,w,w])/Cww
         V_s = votes.view(b,Bkk,Cww,16) #b,Bkk,Cww,16
+        #activations of every capsule i in each capsule c's receptive field
+        a_s = activation.unfold(2,self.K,self.stride).unfold(3,self.K,self.stride) #b,B,w,w,K,K
+        a_s = a_s.permute(0,1,4,5,2,3).contiguous().view(b,self.B,self.K,self.K,1,w,w)
+        a_s = a_s.expand(b,self.B,self.K,self.K,self.C,w,w).contiguous().view(b,Bkk,Cww) #b,Bkk,Cww
+        #R is kept in receptive field layout, i.e. R[:,(B,k_x,k_y),(c,x,y)] is the
+        #assignment of capsule i at (stride*x+k_x, stride*y+k_y) to capsule c at (x,y)
+        R = activation.new_full((b,Bkk,Cww), 1.0/Cww) #b,Bkk,Cww
+        #the E-step looks the votes up at the mirrored kernel offset, (-k) mod K
+        flip = (-torch.arange(self.K, device=activation.device)) % self.K
+        V_e = votes.index_select(2,flip).index_select(3,flip).view(b,Bkk,self.C,w*w,16) #b,Bkk,C,ww,16
+        grad_enabled = torch.is_grad_enabled()
+        converged = False
+        idx = None #types of the capsules c kept per capsule i once sparse
+        self.final_delta = None
         for iterate in range(self.iteration):
-#            t = time()
-            #M-step
-            r_s,a_s = [],[]
-            for typ in range(self.C):
-                for i in range(width_out):
-                    for j in range(width_out):
-                        r = R[:,:,self.stride*i:self.stride*i+self.K,  #b,B,K,K
-                                self.stride*j:self.stride*j+self.K,typ,i,j]
-                        r = Variable(torch.from_numpy(r).float())
-                        if self.use_gpu:
-                            r = r.cuda()
-                        r_s.append(r)
-                        a = activation[:,:,self.stride*i:self.stride*i+self.K,
-                                self.stride*j:self.stride*j+self.K] #b,B,K,K
-                        a_s.append(a)
-
-
-            r_s = torch.stack(r_s,-1).view(b, Bkk, Cww) #b,Bkk,Cww
-            a_s = torch.stack(a_s,-1).view(b, Bkk, Cww) #b,Bkk,Cww
-            r_hat = r_s*a_s #b,Bkk,Cww
-            r_hat = r_hat.clamp(0.01) #prevent nan since we'll devide sth. by r_hat
-            sum_r_hat = r_hat.sum(1).view(b,1,Cww,1).expand(b,1,Cww,16) #b,Cww,16
-            r_hat_stack = r_hat.view(b,Bkk,Cww,1).expand(b, Bkk, Cww,16) #b,Bkk,Cww,16
-            mu = torch.sum(r_hat_stack*V_s, 1, True)/sum_r_hat #b,1,Cww,16
-            mu_stack = mu.expand(b,Bkk,Cww,16) #b,Bkk,Cww,16
-            sigma = torch.sum(r_hat_stack*(V_s-mu_stack)**2,1,True)/sum_r_hat #b,1,Cww,16
-            sigma = sigma.clamp(0.01) #prevent nan since the following is a log(sigma)
-            cost = (self.beta_v + torch.log(sigma)) * sum_r_hat #b,1,Cww,16
-            beta_a_stack = self.beta_a.view(1,self.C,1).expand(b,self.C,w*w).contiguous().view(b,1,Cww)#b,Cww
-            a_c = torch.sigmoid(lambda_*(beta_a_stack-torch.sum(cost,3))) #b,1,Cww
-            mus = mu.view(b,self.C,w,w,16) #b,C,w,w,16
-            sigmas = sigma.view(b,self.C,w,w,16) #b,C,w,w,16
-            activations = a_c.view(b,self.C,w,w) #b,C,w,w
-#            print(time()-t)
-#            t = time()
-
-            #E-step
-            for i in range(width_in):
-                #compute the x axis range of capsules c that i connect to.
-                x_range = (max(math.floor((i-self.K)/self.stride)+1,0),min(i//self.stride+1,width_out))
-                #without padding, some capsules i may not be convolutional layer catched, in mnist case, i or j == 11
-                u = len(range(*x_range))
-                if not u:
-                    continue
-                for j in range(width_in):
-                    y_range = (max(math.floor((j-self.K)/self.stride)+1,0),min(j//self.stride+1,width_out))
-
-                    v = len(range(*y_range))
-                    if not v:
-                        continue
-                    mu = mus[:,:,x_range[0]:x_range[1],y_range[0]:y_range[1],:].contiguous() #b,C,u,v,16
-                    sigma = sigmas[:,:,x_range[0]:x_range[1],y_range[0]:y_range[1],:].contiguous() #b,C,u,v,16
-                    mu = mu.view(b,1,self.C,u,v,16).expand(b,self.B,self.C,u,v,16).contiguous()#b,B,C,u,v,16
-                    sigma = sigma.view(b,1,self.C,u,v,16).expand(b,self.B,self.C,u,v,16).contiguous()#b,B,C,u,v,16
-                    V = []; a = []
-                    for x in range(*x_range):
-                        for y in range(*y_range):
-                            #compute where is the V_ic
-                            pos_x = self.stride*x - i
-                            pos_y = self.stride*y - j
-                            V.append(votes[:,:,pos_x,pos_y,:,x,y,:,:]) #b,B,C,4,4
-                            a.append(activations[:,:,x,y].contiguous().view(b,1,self.C).expand(b,self.B,self.C).contiguous()) #b,B,C
-                    V = torch.stack(V,dim=3).view(b,self.B,self.C,u,v,16) #b,B,C,u,v,16
-                    a = torch.stack(a,dim=3).view(b,self.B,self.C,u,v) #b,B,C,u,v
-                    p = torch.exp(-(V-mu)**2)/torch.sqrt(2*math.pi*sigma) #b,B,C,u,v,16
-                    p = p.prod(dim=5)#b,B,C,u,v
-                    p_hat = a*p  #b,B,C,u,v
-                    sum_p_hat = p_hat.sum(4).sum(3).sum(2) #b,B
-                    sum_p_hat = sum_p_hat.view(b,self.B,1,1,1).expand(b,self.B,self.C,u,v)
-                    r = (p_hat/sum_p_hat) #b,B,C,u,v --> R: b,B,12,12,32,5,5
-
-                    if self.use_gpu:
-                        r = r.cpu()
-                    R[:,:,i,j,:,x_range[0]:x_range[1],        #b,B,u,v,C
-                      y_range[0]:y_range[1]] = r.data.numpy()
-#            print(time()-t)
+            last = converged or iterate == self.iteration-1
+            if self.routing == 'full':
+                track = True
+            elif self.routing == 'last':
+                #with early stopping the last E-step is only known after the fact
+                track = iterate >= self.iteration-2 or self.routing_tol > 0
+            else:
+                track = last
+            with torch.set_grad_enabled(grad_enabled and track):
+                with profiling.section('m_step'):
+                    if idx is None:
+                        mu, sigma, logit_c = self._m_step(R, a_s, V_s, lambda_, w)
+                    else:
+                        mu, sigma, logit_c = self._m_step_sparse(R, a_s, V_s, idx, lambda_, w)
+                self.iterations_run = iterate+1
+                if last:
+                    break
+                with profiling.section('e_step'):
+                    mu_e = mu.view(b,1,self.C,w*w,16)
+                    sigma_e = sigma.view(b,1,self.C,w*w,16)
+                    logit_e = logit_c.view(b,1,self.C,w*w)
+                    if idx is not None:
+                        idx16 = idx.unsqueeze(4).expand(b,Bkk,self.topk,w*w,16)
+                        mu_e = mu_e.expand(b,Bkk,self.C,w*w,16).gather(2, idx16)
+                        sigma_e = sigma_e.expand(b,Bkk,self.C,w*w,16).gather(2, idx16)
+                        logit_e = logit_e.expand(b,Bkk,self.C,w*w).gather(2, idx)
+                    R_new = self._e_step(V_e, mu_e, sigma_e, logit_e, width_in, w)
+                    R_new = R_new.view(R.shape)
+                self.final_delta = (R_new-R).detach().abs().max()
+                R = R_new
+                if self.routing_tol:
+                    converged = self.final_delta.item() < self.routing_tol
+            if idx is None and self.topk and self.topk < self.C:
+                #the kept votes and activations stay linked to the layer input
+                #even when this iteration is not tracked
+                R, V_s, V_e, a_s, idx = self._sparsify(R, V_s, V_e, a_s, w)
+
+        mus = mu.view(b,self.C,w,w,16) #b,C,w,w,16
+        activations = torch.sigmoid(logit_c).view(b,self.C,w,w) #b,C,w,w
+        return mus, activations
+
+    def _capsules(self, pose, activation, lambda_, width_in, w):
+        """
+        Votes of the capsules i (pose b,B,width_in,width_in,16) and the EM
+        routing of them, returning the poses and activations of capsules c.
+        """
+        b = pose.size(0)
+        with profiling.section('votes'):
+            #every capsule i's poses in each capsule c's receptive field, b,B,w,w,16,K,K
+            poses = pose.unfold(2,self.K,self.stride).unfold(3,self.K,self.stride)
+            #the transformation below reads the receptive fields as (16, w*w) blocks
+            #viewed as w,w,4,4, i.e. the memory order of the original stacked windows
+            poses = poses.permute(0,1,5,6,4,2,3).reshape(b,self.B,self.K,self.K,w,w,4,4) #b,B,K,K,w,w,4,4
+            votes = self._votes(poses, w) #b,B,K,K,C,w,w,4,4
+
+            #Coordinate Addition
+            if self.coordinate_add:
+                votes[:,:,:,:,:,:,:,0,:2] += self._coordinate_offsets(width_in, w, votes)
+
+        return self._route(votes, activation, lambda_, width_in, w)
+
+    def forward(self, x, lambda_):
+        b = x.size(0) #batchsize
+        width_in = int(x.size(2))  #12, a constant when traced
+        pose = x[:,:-self.B,:,:].contiguous() #b,16*32,12,12
+        pose = pose.view(b,16,self.B,width_in,width_in).permute(0,2,3,4,1).contiguous() #b,B,12,12,16
+        activation = x[:,-self.B:,:,:] #b,B,12,12
+        w = int((width_in-self.K)/self.stride+1) if self.K else 1 #5
+        if self.transform_share and self.K == 0:
+            self.K = width_in # class Capsules' kernel = width_in
+
+        if self.checkpoint and torch.is_grad_enabled():
+            mus, activations = torch.utils.checkpoint.checkpoint(
+                self._capsules, pose, activation, lambda_, width_in, w, use_reentrant=False)
+        else:
+            mus, activations = self._capsules(pose, activation, lambda_, width_in, w)
 
         mus = mus.permute(0,4,1,2,3).contiguous().view(b,self.C*16,w,w)#b,16*C,5,5
         output = torch.cat([mus,activations], 1) #b,C*17,5,5
         return output
 
+def defaultCapsuleLayers(C=32, D=32, E=10):
+    """
+    The capsule stack of the paper: two convolutional capsule layers and the
+    class capsules. Every layer is described by its name, number of capsule
+    types, kernel (0: the whole input), stride, coordinate addition and
+    transformation sharing; 'iterations' optionally overrides r.
+    """
+    return [{'name': 'convcaps1', 'types': C, 'kernel': 3, 'stride': 2,
+             'coordinate_add': False, 'transform_share': False},
+            {'name': 'convcaps2', 'types': D, 'kernel': 3, 'stride': 1,
+             'coordinate_add': False, 'transform_share': False},
+            {'name': 'classcaps', 'types': E, 'kernel': 0, 'stride': 1,
+             'coordinate_add': True, 'transform_share': True}]
+
 class CapsNet(nn.Module):
-    def __init__(self,A=32,B=32,C=32,D=32,E=10,r=3,use_gpu=False):
+    """
+    Conv1, primary capsules, a stack of ConvCaps layers and the segmentation
+    network. The stack is given by layers (see defaultCapsuleLayers, which
+    builds it from C, D and E if layers is None); its last layer must have
+    E types, one per class.
+    """
+    def __init__(self,A=32,B=32,C=32,D=32,E=10,r=3,use_gpu=False,routing='detach',
+                 vote_chunk=0,log_domain=False,routing_tol=0,checkpoint=(),routing_topk=0,
+                 layers=None,conv1_kernel=5,conv1_stride=2):
         super(CapsNet, self).__init__()
         self.num_classes = E
+        if layers is None:
+            layers = defaultCapsuleLayers(C, D, E)
+        if layers[-1]['types'] != E:
+            raise ValueError('The last capsule layer needs %d types (one per class), not %d'
+                             % (E, layers[-1]['types']))
         self.conv1 = nn.Conv2d(in_channels=3, out_channels=A,
-                               kernel_size=5, stride=2)
+                               kernel_size=conv1_kernel, stride=conv1_stride)
         self.primary_caps = PrimaryCaps(A,B)
-        self.convcaps1 = ConvCaps(B, C, kernel = 3, stride=2,iteration=r, use_gpu=use_gpu,
-                                  coordinate_add=False, transform_share = False)
-        self.convcaps2 = ConvCaps(C, D, kernel = 3, stride=1,iteration=r, use_gpu=use_gpu,
-                                  coordinate_add=False, transform_share = False)
-        self.classcaps = ConvCaps(D, E, kernel = 0, stride=1,iteration=r, use_gpu=use_gpu,
-                                  coordinate_add=True, transform_share = True)
+        self.capsule_layers = []
+        self.layer_specs = layers
+        types_in = B
+        for layer in layers:
+            name = layer['name']
+            if name in self.capsule_layers:
+                raise ValueError('Capsule layer %s is listed twice' % name)
+            if hasattr(self, name) or name == 'seg':
+                raise ValueError('Capsule layer name %s is taken by CapsNet' % name)
+            if layer['kernel'] == 0 and not layer.get('transform_share', False):
+                raise ValueError('Capsule layer %s: kernel 0 (the whole input) needs transform_share'
+                                 % name)
+            setattr(self, name, ConvCaps(types_in, layer['types'], kernel=layer['kernel'],
+                    stride=layer['stride'], iteration=layer.get('iterations') or r,
+                    use_gpu=use_gpu, coordinate_add=layer.get('coordinate_add', False),
+                    transform_share=layer.get('transform_share', False),
+                    routing=routing, vote_chunk=vote_chunk,
+                    log_domain=log_domain, routing_tol=routing_tol,
+                    checkpoint=name in checkpoint, topk=routing_topk))
+            self.capsule_layers.append(name)
+            types_in = layer['types']
         self.seg = segmentationNet(self.num_classes)
 
     def forward(self,x,lambda_): #b,1,28,28
@@ -222,33 +449,96 @@ class CapsNet(nn.Module):
         if verbose:
             print('Image Input')
             print(x.data.shape)
-        x = F.relu(self.conv1(x)) #b,32,12,12
+        with profiling.section('conv1'):
+            x = F.relu(self.conv1(x)) #b,32,12,12
         if verbose:
             print('After conv1')
             print(x.data.shape)
-        x = self.primary_caps(x) #b,32*(4*4+1),12,12
+        with profiling.section('primary_caps'):
+            x = self.primary_caps(x) #b,32*(4*4+1),12,12
         if verbose:
             print('After Primary Caps')
             print(x.data.shape)
-        x = self.convcaps1(x,lambda_) #b,32*(4*4+1),5,5
-        if verbose:
-            print('After ConvCaps1')
-            print(x.data.shape)
-        x = self.convcaps2(x,lambda_) #b,32*(4*4+1),3,3
-        if verbose:
-            print('After ConvCaps2')
-            print(x.data.shape)
-        x = self.classcaps(x,lambda_)
-        if verbose:
-            print('After ClassCaps')
-            print(x.data.shape)
-        seg = self.seg(x)
+        for name in self.capsule_layers:
+            with profiling.section(name):
+                x = getattr(self, name)(x,lambda_) #b,C*(4*4+1),w,w
+            if verbose:
+                print('After ' + name)
+                print(x.data.shape)
+        with profiling.section('seg'):
+            seg = self.seg(x)
         #x = x.view(-1,self.num_classes*16+self.num_classes) #b,10*16+10
         #if verbose:
         #    print('After ClassCaps Reshape')
         #    print(x.data.shape)
         return x, seg
 
+    def routingStats(self):
+        '''
+            Number of routing iterations each capsule layer ran in the last
+            forward pass and the last change of its routing coefficients.
+        '''
+        stats = []
+        for name in self.capsule_layers:
+            layer = getattr(self, name)
+            delta = layer.final_delta
+            stats.append((name, layer.iterations_run,
+                          float(delta) if delta is not None else float('nan')))
+        return stats
+
+    def estimateCost(self, imageSize, batch=1):
+        '''
+            Rough forward cost of every layer for a batch of
+            imageSize x imageSize images. Returns a list of (name, output
+            width, parameters, GFLOPs, activation MB) rows, where the
+            activation memory of a capsule layer is the float32 working set
+            of its routing (votes and the M/E-step temporaries).
+        '''
+        def params(module):
+            return sum(p.numel() for p in module.parameters())
+        rows = []
+        k, s = self.conv1.kernel_size[0], self.conv1.stride[0]
+        width = (imageSize - k)//s + 1
+        A, B = self.conv1.out_channels, self.primary_caps.B
+        rows.append(('conv1', width, params(self.conv1),
+                     2*batch*3*A*k*k*width*width, 4*batch*A*width*width))
+        rows.append(('primary_caps', width, params(self.primary_caps),
+                     2*batch*A*17*B*width*width, 4*batch*17*B*width*width))
+        for spec in self.layer_specs:
+            name = spec['name']
+            layer = getattr(self, name)
+            K = spec['kernel'] or width
+            w = (width - K)//layer.stride + 1
+            pairs = batch*layer.B*K*K*layer.C*w*w #votes of every capsule i for every c
+            sparse = pairs*min(layer.topk, layer.C)//layer.C if layer.topk else pairs
+            r = layer.iteration
+            # 4x4 matmul per vote, ~6 flops per pose entry in every M- and E-step,
+            # the steps after the first E-step on the top-k pairs only
+            flops = 128*pairs + 16*6*(2*pairs + (2*r - 3)*sparse if r > 1 else pairs)
+            rows.append((name, w, params(layer), flops, 5*4*16*pairs))
+            width = w
+        seg_flops, size = 0, width
+        for m in self.seg.main:
+            if isinstance(m, nn.ConvTranspose2d):
+                seg_flops += 2*batch*m.in_channels*m.out_channels*m.kernel_size[0]**2*size*size
+                size = (size - 1)*m.stride[0] - 2*m.padding[0] + m.kernel_size[0]
+        rows.append(('seg', size, params(self.seg), seg_flops,
+                     4*batch*self.num_classes*size*size))
+        return [(name, w, p, f/1e9, mem/2.0**20) for name, w, p, f, mem in rows]
+
+    def costSummary(self, imageSize, batch=1):
+        '''
+            Table of estimateCost with the totals.
+        '''
+        rows = self.estimateCost(imageSize, batch)
+        lines = ['Estimated cost for %d images of %dx%d:' % (batch, imageSize, imageSize),
+                 '    %-16s %6s %12s %10s %12s' % ('layer', 'width', 'params', 'GFLOPs', 'act. MB')]
+        for row in rows:
+            lines.append('    %-16s %6d %12d %10.3f %12.1f' % row)
+        lines.append('    %-16s %6s %12d %10.3f %12.1f' % ('total', '', sum(r[2] for r in rows),
+                     sum(r[3] for r in rows), sum(r[4] for r in rows)))
+        return '\n'.join(lines)
+
     def loss(self, x, target, m, nc): #x:b,10 target:b
         print(x[0])
         b = x.size(0)
@@ -0,0 +1,277 @@
+'''
+Batched inference for the CapsNet segmentation output.
+
+A Predictor loads the network once and serves segmentation requests. Requests
+submitted concurrently are grouped into micro-batches of up to max_batch
+images, waiting at most max_wait seconds for a batch to fill up.
+
+Usage:
+    python predictor.py --net model.pth --json dataset/cityscapesClasses.json \
+        --serve http --port 8000
+    curl --data-binary @image.png localhost:8000/predict?output=color > mask.png
+
+    echo "image.png mask.png" | python predictor.py --net model.pth --serve stdin
+'''
+
+import argparse
+import json
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+import checkpoints
+import config
+import models.matrixCapsules as capsNet
+import utils
+
+class Predictor(object):
+    '''
+        Segments RGB images with a CapsNet.
+
+        Args:
+            key: class key from utils.disentangleKey
+            net: path to the state dict of the network (random weights if not set)
+            imageSize: height/width of the network input
+            r: routing iterations
+            lambda_: inverse temperature of the routing
+            device: device the network runs on
+            max_batch: largest micro-batch
+            max_wait: seconds a request waits for a micro-batch to fill up
+            model_kwargs: further CapsNet arguments (A, B, layers, routing, ...),
+                          the architecture stored in a checkpoint from
+                          main.py takes precedence
+    '''
+
+    def __init__(self, key, net=None, imageSize=128, r=3, lambda_=0.9, device=None,
+                 max_batch=8, max_wait=0.01, **model_kwargs):
+        self.key = key
+        self.num_classes = len(key) + 1
+        self.imageSize = imageSize
+        self.lambda_ = lambda_
+        self.device = torch.device(device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+
+        model_kwargs.setdefault('use_gpu', self.device.type == 'cuda')
+        state = torch.load(net, map_location='cpu', weights_only=False) if net else None
+        if isinstance(state, dict) and 'config' in state:
+            model_kwargs.update(config.capsNetKwargs(config.runConfig(state), self.num_classes, r))
+        self.model = capsNet.CapsNet(E=self.num_classes, r=r, **model_kwargs)
+        if state is not None:
+            self.model.load_state_dict(checkpoints.modelState(state))
+        self.model.to(self.device).eval()
+        self.palette = utils.colorPalette(self.key, self.device)
+
+        # Input batch, filled in place for every micro-batch
+        self.buffer = torch.empty(max_batch, 3, imageSize, imageSize, device=self.device)
+        if self.device.type == 'cuda':
+            self.staging = torch.empty(max_batch, imageSize, imageSize, 3,
+                                       dtype=torch.uint8).pin_memory()
+            # Recorded after each copy out of staging, which is asynchronous
+            self.copied = torch.cuda.Event()
+        else:
+            self.staging = torch.empty(max_batch, imageSize, imageSize, 3, dtype=torch.uint8)
+
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.worker = None
+
+    def _preprocess(self, image):
+        '''
+            Resizes an [H, W, 3] uint8 RGB image to the network input size.
+        '''
+        if image.shape[:2] != (self.imageSize, self.imageSize):
+            image = cv2.resize(image, (self.imageSize, self.imageSize),
+                               interpolation=cv2.INTER_NEAREST)
+        return torch.from_numpy(np.ascontiguousarray(image))
+
+    def _forward(self, images):
+        '''
+            Runs one batch of at most max_batch images, returns the class
+            index maps at the input size as a [n, imageSize, imageSize] uint8
+            tensor on the device.
+        '''
+        n = len(images)
+        with self.lock, torch.inference_mode():
+            if self.device.type == 'cuda':
+                # The previous batch may still be copied out of staging
+                self.copied.synchronize()
+            for i, image in enumerate(images):
+                self.staging[i].copy_(self._preprocess(image))
+            batch = self.buffer[:n]
+            batch.copy_(self.staging[:n].permute(0,3,1,2), non_blocking=True)
+            if self.device.type == 'cuda':
+                self.copied.record()
+            batch.div_(255)
+            _, seg = self.model(batch, self.lambda_)
+            seg = F.interpolate(seg, size=(self.imageSize, self.imageSize),
+                                mode='bilinear', align_corners=False)
+            return seg.argmax(1).byte()
+
+    def _decode(self, label, shape, output):
+        '''
+            Converts an index map to the requested output at the size of the
+            original image.
+        '''
+        if output == 'color':
+            label = self.palette[label.long()]
+        label = label.cpu().numpy()
+        if label.shape[:2] != shape[:2]:
+            label = cv2.resize(label, (shape[1], shape[0]), interpolation=cv2.INTER_NEAREST)
+        return label
+
+    def predict(self, images, output='index'):
+        '''
+            Segments a list of [H, W, 3] uint8 RGB images in batches of
+            max_batch. Returns a list of [H, W] uint8 class index maps, or of
+            [H, W, 3] uint8 RGB colour masks if output is 'color'.
+        '''
+        results = []
+        for start in range(0, len(images), self.max_batch):
+            chunk = images[start:start + self.max_batch]
+            labels = self._forward(chunk)
+            results.extend(self._decode(label, image.shape, output)
+                           for label, image in zip(labels, chunk))
+        return results
+
+    def submit(self, image, output='index'):
+        '''
+            Queues one image for the next micro-batch. Returns a Future
+            resolving to the result of predict for that image.
+        '''
+        if self.worker is None:
+            with self.lock:
+                if self.worker is None:
+                    self.worker = threading.Thread(target=self._serve, name='Predictor',
+                                                   daemon=True)
+                    self.worker.start()
+        future = Future()
+        self.requests.put((image, output, future))
+        return future
+
+    def _serve(self):
+        while True:
+            pending = [self.requests.get()]
+            deadline = time.time() + self.max_wait
+            while len(pending) < self.max_batch:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(self.requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                labels = self._forward([image for image, _, _ in pending])
+                for label, (image, output, future) in zip(labels, pending):
+                    future.set_result(self._decode(label, image.shape, output))
+            except Exception as e:
+                for _, _, future in pending:
+                    future.set_exception(e)
+
+def _handler(predictor):
+    class PredictHandler(BaseHTTPRequestHandler):
+        '''
+            POST /predict[?output=index|color] with an encoded image as the
+            body, answers with the segmentation as a PNG.
+        '''
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != '/predict':
+                self.send_error(404)
+                return
+            output = parse_qs(url.query).get('output', ['index'])[0]
+            data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+            if image is None:
+                self.send_error(400, 'Could not decode the image')
+                return
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+            result = predictor.submit(image, output).result()
+            if output == 'color':
+                result = cv2.cvtColor(result, cv2.COLOR_RGB2BGR)
+            body = cv2.imencode('.png', result)[1].tobytes()
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return PredictHandler
+
+def serveHTTP(predictor, host='127.0.0.1', port=8000):
+    server = ThreadingHTTPServer((host, port), _handler(predictor))
+    print('Serving on http://%s:%d/predict' % (host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+def serveStdin(predictor, output='color'):
+    '''
+        Reads lines of "<input image> <output image>" from stdin and writes
+        the segmentation of every input, one output path per line on stdout.
+    '''
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        in_path, out_path = line.split()
+        image = cv2.cvtColor(cv2.imread(in_path, cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+        result = predictor.predict([image], output)[0]
+        if output == 'color':
+            result = cv2.cvtColor(result, cv2.COLOR_RGB2BGR)
+        cv2.imwrite(out_path, result)
+        print(out_path)
+        sys.stdout.flush()
+
+def main():
+    parser = argparse.ArgumentParser(description='CapsNet segmentation server')
+    parser.add_argument('--net', default='',
+                help='path to the trained network')
+    parser.add_argument('--json', default='dataset/cityscapesClasses.json',
+                help='json file with the class definitions')
+    parser.add_argument('--imageSize', default=128, type=int,
+                help='height/width of the input image to the network')
+    parser.add_argument('--config', default='',
+                help='run config the network was trained with, if --net does not store one (see config.py)')
+    parser.add_argument('--r', type=int, default=3,
+                help='Number of Routing Iterations')
+    parser.add_argument('--lambda', dest='lambda_', default=0.9, type=float,
+                help='inverse temperature of the routing (default: 0.9)')
+    parser.add_argument('--max-batch', dest='max_batch', default=8, type=int,
+                help='largest micro-batch (default: 8)')
+    parser.add_argument('--max-wait', dest='max_wait', default=10, type=float,
+                help='milliseconds a request waits for a micro-batch to fill (default: 10)')
+    parser.add_argument('--serve', default='http', choices=['http', 'stdin'],
+                help='front end (default: http)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', default=8000, type=int)
+    parser.add_argument('--output', default='color', choices=['index', 'color'],
+                help='stdin front end output (default: color)')
+    args = parser.parse_args()
+
+    key = utils.disentangleKey(json.load(open(args.json))['classes'])
+    predictor = Predictor(key, args.net, args.imageSize, args.r, args.lambda_,
+                          max_batch=args.max_batch, max_wait=args.max_wait / 1e3,
+                          **config.capsNetKwargs(config.loadConfig(args.config), len(key) + 1, args.r))
+    if args.serve == 'http':
+        serveHTTP(predictor, args.host, args.port)
+    else:
+        serveStdin(predictor, args.output)
+
+if __name__ == '__main__':
+    main()
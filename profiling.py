@@ -0,0 +1,228 @@
+'''
+Opt-in instrumentation of the training step.
+
+Code marks the parts of a step with profiling.section(name). Sections can be
+nested, a nested section is reported under 'outer/inner'. Nothing is recorded
+unless a StepProfiler has been enabled, so the sections cost a function call
+otherwise.
+'''
+
+import collections
+import contextlib
+import json
+import os
+import resource
+import time
+
+import torch
+
+_active = None
+
+def enable(profiler):
+    global _active
+    _active = profiler
+
+def disable():
+    global _active
+    _active = None
+
+def active():
+    return _active
+
+def section(name):
+    '''
+        Context manager timing a part of the step, a no-op when profiling
+        is disabled.
+    '''
+    if _active is None:
+        return contextlib.nullcontext()
+    return _active.section(name)
+
+def record(name, seconds):
+    '''
+        Records a part of the step that was timed by the caller, e.g. the
+        time spent waiting for the data loader.
+    '''
+    if _active is not None:
+        _active.record(name, seconds)
+
+def step():
+    '''
+        Marks the end of a training step.
+    '''
+    if _active is not None:
+        _active.step()
+
+def _resetPeakRSS():
+    '''
+        Resets the peak resident set size of the process (Linux >= 4.0).
+        Returns False where that is not supported.
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+def _peakRSS():
+    '''
+        Peak resident set size of the process in bytes since the last
+        _resetPeakRSS.
+    '''
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) * 1024
+    raise OSError('No VmHWM in /proc/self/status')
+
+def _currentRSS():
+    '''
+        Resident set size of the process in bytes.
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class StepProfiler(object):
+    '''
+        Records wall time and memory of every section of the training step.
+
+        Memory is the peak allocated CUDA memory within the section on the
+        GPU, and the peak resident set size within the section on the CPU.
+        Where the peak RSS cannot be reset (non-Linux), the resident set size
+        at the end of the section is recorded and labelled as such.
+
+        Args:
+            summary_every: print a summary of the last N steps every N steps
+                           (0 never prints)
+            trace_dir: if set, dumpEpoch writes a JSON summary and a Chrome
+                       trace (chrome://tracing, Perfetto) of the epoch there
+    '''
+
+    def __init__(self, summary_every=0, trace_dir=None):
+        self.summary_every = summary_every
+        self.trace_dir = trace_dir
+        self.cuda = torch.cuda.is_available()
+        self.peak = self.cuda or _resetPeakRSS()
+        self.memory_label = 'peak MB' if self.peak else 'RSS at end MB'
+        self.stack = []
+        self.steps = 0
+        self.step_start = time.time()
+        self.window = collections.defaultdict(lambda: [0.0, 0])  # name: [seconds, peak bytes]
+        self.window_time = 0.0
+        self.window_steps = 0
+        self.epoch = collections.defaultdict(lambda: [0.0, 0])
+        self.epoch_time = 0.0
+        self.epoch_steps = 0
+        self.events = []
+        self.t0 = time.time()
+
+    def _sync(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+
+    def _memory(self):
+        if self.cuda:
+            return torch.cuda.max_memory_allocated()
+        if self.peak:
+            return _peakRSS()
+        return _currentRSS()
+
+    def _resetPeak(self):
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats()
+        elif self.peak:
+            _resetPeakRSS()
+
+    @contextlib.contextmanager
+    def section(self, name):
+        self._sync()
+        if self.stack:
+            name = self.stack[-1][0] + '/' + name
+        self.stack.append([name, 0])
+        self._resetPeak()
+        start = time.time()
+        try:
+            yield
+        finally:
+            self._sync()
+            end = time.time()
+            _, inner_peak = self.stack.pop()
+            peak = max(self._memory(), inner_peak)
+            if self.stack:
+                # the reset above hid this section's memory from the outer one
+                self.stack[-1][1] = max(self.stack[-1][1], peak)
+            self._add(name, end - start, peak, start)
+
+    def record(self, name, seconds):
+        self._add(name, seconds, self._memory(), time.time() - seconds)
+
+    def _add(self, name, seconds, peak, start):
+        for totals in (self.window, self.epoch):
+            totals[name][0] += seconds
+            totals[name][1] = max(totals[name][1], peak)
+        if self.trace_dir:
+            self.events.append({'name': name, 'ph': 'X', 'pid': 0,
+                                'tid': name.count('/'),
+                                'ts': (start - self.t0) * 1e6, 'dur': seconds * 1e6,
+                                'args': {self.memory_key: peak / 2.0**20}})
+
+    def step(self):
+        now = time.time()
+        self.window_time += now - self.step_start
+        self.epoch_time += now - self.step_start
+        self.step_start = now
+        self.steps += 1
+        self.window_steps += 1
+        self.epoch_steps += 1
+        if self.summary_every and self.steps % self.summary_every == 0:
+            print(self.summary(self.window, self.window_time, self.window_steps,
+                               self.memory_label))
+            self.window.clear()
+            self.window_time = 0.0
+            self.window_steps = 0
+
+    @property
+    def memory_key(self):
+        return 'peak_memory_mb' if self.peak else 'rss_at_end_mb'
+
+    @staticmethod
+    def summary(totals, total_time, steps, memory_label='peak MB'):
+        '''
+            Table of the mean time per step of every section, its share of the
+            step time and its memory.
+        '''
+        steps = max(steps, 1)
+        lines = ['Step time breakdown over %d steps: %.1f ms/step' % (steps, 1e3 * total_time / steps),
+                 '    %-40s %10s %7s %14s' % ('section', 'ms/step', '%', memory_label)]
+        for name, (seconds, peak) in sorted(totals.items()):
+            lines.append('    %-40s %10.2f %6.1f%% %14.1f'
+                         % (name, 1e3 * seconds / steps, 100 * seconds / max(total_time, 1e-12),
+                            peak / 2.0**20))
+        return '\n'.join(lines)
+
+    def dumpEpoch(self, epoch):
+        '''
+            Writes the summary and the trace of the epoch to trace_dir, and
+            starts a new epoch.
+        '''
+        if self.trace_dir:
+            if not os.path.exists(self.trace_dir):
+                os.makedirs(self.trace_dir)
+            steps = max(self.epoch_steps, 1)
+            summary = {'epoch': epoch, 'steps': self.epoch_steps,
+                       'ms_per_step': 1e3 * self.epoch_time / steps,
+                       'sections': {name: {'ms_per_step': 1e3 * seconds / steps,
+                                           self.memory_key: peak / 2.0**20}
+                                    for name, (seconds, peak) in self.epoch.items()}}
+            with open(os.path.join(self.trace_dir, 'profile_epoch_%03d.json' % epoch), 'w') as f:
+                json.dump(summary, f, indent=2)
+            with open(os.path.join(self.trace_dir, 'trace_epoch_%03d.json' % epoch), 'w') as f:
+                json.dump({'traceEvents': self.events}, f)
+        self.epoch.clear()
+        self.epoch_time = 0.0
+        self.epoch_steps = 0
+        self.events = []
@@ -0,0 +1,378 @@
+'''
+Hyperparameter sweep over main.py on a single host.
+
+Trials run as concurrent main.py processes, each pinned to its own disjoint
+set of CPU cores (and limited to as many threads), so trials do not fight
+over cores. The cityscapes shards of every image size in the search space are
+built once before the first trial and memory-mapped read-only by all trials,
+which then share the page cache. Every trial reports the validation mIoU of
+each epoch (--metrics-file); a trial whose best mIoU after an epoch is below
+the median of the other trials at the same epoch is stopped early. The
+results are written to results.csv and results.json in the output directory.
+
+The search space is a JSON (or YAML) file:
+
+    {
+      "args": ["--epochs", "10", "--batchSize", "8"],
+      "config": "configs/small.json",
+      "search": "random",
+      "trials": 24,
+      "seed": 0,
+      "space": {
+        "--lr": {"min": 1e-4, "max": 1e-2, "log": true},
+        "--r": [2, 3],
+        "--imageSize": [64, 128],
+        "model.layers.0.types": [8, 16, 32],
+        "schedule.lambda.increment": {"min": 0.1, "max": 0.4}
+      }
+    }
+
+'args' are passed to every trial and 'config' is the base run config (see
+config.py). Keys of 'space' starting with '--' are main.py arguments (true
+and false switch flags on and off), the others are dotted paths into the run
+config, where numbers index lists. With "search": "grid" every combination
+of the value lists is run, with "random" 'trials' samples are drawn; ranges
+are sampled uniformly, or log-uniformly with "log", and rounded with "int".
+
+Usage:
+    python sweep.py space.json --out sweep_r_lr --cores-per-trial 4 --cache-dir <cache>
+'''
+
+import argparse
+import copy
+import csv
+import itertools
+import json
+import math
+import os
+import random
+import signal
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import config
+
+def sampleTrials(spec):
+    '''
+        List of {key: value} settings, one per trial.
+    '''
+    space = spec['space']
+    keys = sorted(space)
+    if spec.get('search', 'grid') == 'grid':
+        for k in keys:
+            if not isinstance(space[k], list):
+                raise ValueError('Grid search needs a list of values for %s' % k)
+        return [dict(zip(keys, values)) for values in itertools.product(*[space[k] for k in keys])]
+    rng = random.Random(spec.get('seed', 0))
+    trials = []
+    for _ in range(spec.get('trials', 10)):
+        trial = {}
+        for k in keys:
+            values = space[k]
+            if isinstance(values, list):
+                trial[k] = rng.choice(values)
+            elif values.get('log'):
+                trial[k] = math.exp(rng.uniform(math.log(values['min']), math.log(values['max'])))
+            else:
+                trial[k] = rng.uniform(values['min'], values['max'])
+            if isinstance(values, dict) and values.get('int'):
+                trial[k] = int(round(trial[k]))
+        trials.append(trial)
+    return trials
+
+def setConfigValue(run_config, path, value):
+    '''
+        Sets the entry at a dotted path like 'model.layers.0.types'.
+    '''
+    keys = path.split('.')
+    node = run_config
+    for k in keys[:-1]:
+        node = node[int(k)] if isinstance(node, list) else node[k]
+    if isinstance(node, list):
+        node[int(keys[-1])] = value
+    else:
+        node[keys[-1]] = value
+
+def trialArgs(settings):
+    '''
+        main.py arguments of the '--' keys of a trial.
+    '''
+    args = []
+    for k, v in sorted(settings.items()):
+        if not k.startswith('--'):
+            continue
+        if isinstance(v, bool):
+            args += [k] if v else []
+        else:
+            args += [k, str(v)]
+    return args
+
+def imageSizes(spec, trials):
+    '''
+        Image sizes the trials train at, the last --imageSize wins as in
+        argparse.
+    '''
+    args = spec.get('args', [])
+    size = 128 # main.py default
+    for i, a in enumerate(args[:-1]):
+        if a == '--imageSize':
+            size = int(args[i + 1])
+    return sorted(set(int(t.get('--imageSize', size)) for t in trials))
+
+def buildCaches(run_config, cache_root, sizes, workers):
+    '''
+        Builds the train and val shards of every image size unless a valid
+        one exists already. Trials memory-map the shards read-only.
+    '''
+    from dataset import cityscapesCache
+    from dataset.cityscapesDataLoader import cityscapesDataset
+
+    data = run_config['data']
+    for size in sizes:
+        for split in ('train', 'val'):
+            dataset = cityscapesDataset(data['data_dir'], split, json_path=data['json_path'])
+            path = cityscapesCache.shardDir(cache_root, split, size, data['json_path'])
+            index = cityscapesCache.loadShardIndex(path)
+            if index is not None and index['samples'] == dataset.relativeNames():
+                print('Using the %s shards in %s' % (split, path))
+                continue
+            cityscapesCache.buildShards(dataset, cache_root, size, workers=workers)
+            print('Wrote %d %s samples to %s' % (len(dataset), split, path))
+
+def coreSets(cores_per_trial, parallel=0):
+    '''
+        Disjoint sets of cores_per_trial cores this process may run on, one
+        per concurrent trial.
+    '''
+    if hasattr(os, 'sched_getaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    slots = max(1, len(cores) // cores_per_trial)
+    if parallel:
+        slots = min(slots, parallel)
+    return [cores[i*cores_per_trial:(i + 1)*cores_per_trial] or cores for i in range(slots)]
+
+def readMetrics(path):
+    '''
+        Per epoch metrics written by main.py --metrics-file.
+    '''
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        lines = f.read().splitlines()
+    # The last line may still be being written
+    metrics = []
+    for line in lines:
+        try:
+            metrics.append(json.loads(line))
+        except ValueError:
+            break
+    return metrics
+
+def bestSoFar(metrics):
+    '''
+        Best mIoU up to every reported epoch.
+    '''
+    return list(np.maximum.accumulate([e['mIoU'] for e in metrics])) if metrics else []
+
+class Trial(object):
+    '''
+        One main.py run with its settings, output directory and status.
+    '''
+
+    def __init__(self, index, settings, out_dir):
+        self.index = index
+        self.name = 'trial_%03d' % index
+        self.settings = settings
+        self.dir = os.path.abspath(os.path.join(out_dir, self.name))
+        self.metrics_path = os.path.join(self.dir, 'metrics.jsonl')
+        self.process = None
+        self.cores = None
+        self.status = 'pending'
+        self.start = self.end = None
+        self.metrics = []
+
+    def launch(self, spec, base_config, cache_root, cores):
+        if not os.path.exists(self.dir):
+            os.makedirs(self.dir)
+        run_config = copy.deepcopy(base_config)
+        for k, v in self.settings.items():
+            if not k.startswith('--'):
+                setConfigValue(run_config, k, v)
+        config_path = os.path.join(self.dir, 'config.json')
+        with open(config_path, 'w') as f:
+            json.dump(run_config, f, indent=4)
+        if os.path.exists(self.metrics_path):
+            os.remove(self.metrics_path)
+
+        # No windows and few checkpoints by default, and one data loading
+        # worker: with the shards loading is cheap and the cores are for
+        # the model
+        cmd = [sys.executable, 'main.py', '--vis-interval', '0', '--keep-checkpoints', '1',
+               '--workers', '1']
+        cmd += spec.get('args', []) + trialArgs(self.settings)
+        cmd += ['--config', config_path, '--save-dir', os.path.join(self.dir, 'checkpoints'),
+                '--resume', 'none', '--metrics-file', self.metrics_path]
+        if cache_root:
+            cmd += ['--cache-dir', cache_root]
+
+        env = dict(os.environ)
+        for var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS'):
+            env[var] = str(len(cores))
+        pin = None
+        if hasattr(os, 'sched_setaffinity'):
+            pin = lambda: os.sched_setaffinity(0, cores)
+        with open(os.path.join(self.dir, 'command.txt'), 'w') as f:
+            f.write(' '.join(cmd) + '\n')
+        self.log = open(os.path.join(self.dir, 'log.txt'), 'w')
+        self.process = subprocess.Popen(cmd, stdout=self.log, stderr=subprocess.STDOUT, env=env,
+                                        preexec_fn=pin, cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.cores = cores
+        self.status = 'running'
+        self.start = time.time()
+
+    def poll(self):
+        '''
+            Reads new metrics, returns True once the process has exited.
+        '''
+        self.metrics = readMetrics(self.metrics_path)
+        code = self.process.poll()
+        if code is None:
+            return False
+        self.end = time.time()
+        self.log.close()
+        if self.status == 'running':
+            self.status = 'done' if code == 0 else 'failed (%d)' % code
+        return True
+
+    def stop(self, reason):
+        self.status = reason
+        self.process.send_signal(signal.SIGTERM)
+
+    def row(self):
+        best = bestSoFar(self.metrics)
+        elapsed = (self.end or time.time()) - self.start if self.start else 0.0
+        return {'trial': self.name, 'status': self.status, 'epochs': len(self.metrics),
+                'best_mIoU': best[-1] if best else float('nan'),
+                'minutes': elapsed / 60.0,
+                'epoch_seconds': (float(np.mean([e['seconds'] for e in self.metrics]))
+                                  if self.metrics else float('nan')),
+                'settings': self.settings}
+
+def medianStop(trial, trials, grace_epochs, min_peers):
+    '''
+        Median stopping rule: True if the best mIoU of trial after its last
+        epoch is below the median of the best mIoU of the other trials after
+        the same number of epochs. Only applied after grace_epochs and when
+        at least min_peers other trials got that far.
+    '''
+    best = bestSoFar(trial.metrics)
+    epoch = len(best)
+    if epoch < max(1, grace_epochs):
+        return False
+    peers = [bestSoFar(t.metrics) for t in trials if t is not trial]
+    peers = [p[epoch - 1] for p in peers if len(p) >= epoch]
+    return len(peers) >= min_peers and best[-1] < np.median(peers)
+
+def writeResults(trials, out_dir):
+    rows = sorted((t.row() for t in trials if t.start),
+                  key=lambda r: -r['best_mIoU'] if not math.isnan(r['best_mIoU']) else float('inf'))
+    with open(os.path.join(out_dir, 'results.json'), 'w') as f:
+        json.dump(rows, f, indent=4)
+    keys = sorted(set(k for t in trials for k in t.settings))
+    with open(os.path.join(out_dir, 'results.csv'), 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['trial', 'status', 'epochs', 'best_mIoU', 'minutes', 'epoch_seconds'] + keys)
+        for r in rows:
+            writer.writerow([r['trial'], r['status'], r['epochs'], r['best_mIoU'], r['minutes'],
+                             r['epoch_seconds']] + [r['settings'].get(k, '') for k in keys])
+    return rows
+
+def resultsTable(rows):
+    lines = ['%-10s %-16s %6s %9s %8s %9s  %s' % ('trial', 'status', 'epochs', 'best mIoU',
+                                                 'minutes', 's/epoch', 'settings')]
+    for r in rows:
+        settings = ' '.join('%s=%.4g' % (k, v) if isinstance(v, float) else '%s=%s' % (k, v)
+                            for k, v in sorted(r['settings'].items()))
+        lines.append('%-10s %-16s %6d %9.4f %8.1f %9.1f  %s' % (r['trial'], r['status'], r['epochs'],
+                     r['best_mIoU'], r['minutes'], r['epoch_seconds'], settings))
+    return '\n'.join(lines)
+
+def runSweep(spec, out_dir, cores_per_trial, parallel=0, cache_root='', grace_epochs=2,
+             min_peers=3, poll=10.0, cache_workers=4):
+    '''
+        Runs all trials of spec, at most one per core set at a time.
+        Returns the result rows, best first.
+    '''
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    base_config = config.loadConfig(spec.get('config'))
+    trials = [Trial(i, s, out_dir) for i, s in enumerate(sampleTrials(spec))]
+    if cache_root:
+        cache_root = os.path.abspath(cache_root)
+        buildCaches(base_config, cache_root, imageSizes(spec, [t.settings for t in trials]),
+                    cache_workers)
+
+    free = coreSets(cores_per_trial, parallel)
+    print('%d trials, %d at a time on cores %s' % (len(trials), len(free), free))
+    pending, running = list(trials), []
+    start = time.time()
+    try:
+        while pending or running:
+            while pending and free:
+                trial = pending.pop(0)
+                trial.launch(spec, base_config, cache_root, free.pop(0))
+                running.append(trial)
+                print('[%s] started on cores %s: %s' % (trial.name, trial.cores, trial.settings))
+            time.sleep(poll)
+            for trial in list(running):
+                if trial.poll():
+                    running.remove(trial)
+                    free.append(trial.cores)
+                    print('[%s] %s after %d epochs' % (trial.name, trial.status, len(trial.metrics)))
+                elif trial.status == 'running' and medianStop(trial, trials, grace_epochs, min_peers):
+                    trial.stop('stopped')
+            writeResults(trials, out_dir)
+    except KeyboardInterrupt:
+        for trial in running:
+            trial.stop('interrupted')
+        for trial in running:
+            trial.process.wait()
+            trial.poll()
+    rows = writeResults(trials, out_dir)
+    hours = (time.time() - start) / 3600.0
+    print(resultsTable(rows))
+    print('%d trials in %.2f h (%.1f trials/h)' % (len(rows), hours, len(rows) / max(hours, 1e-9)))
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description='Hyperparameter sweep over main.py')
+    parser.add_argument('space',
+                help='JSON/YAML search space (see the module docstring)')
+    parser.add_argument('--out', default='sweep',
+                help='directory for the trials and the results (default: sweep)')
+    parser.add_argument('--cores-per-trial', dest='cores_per_trial', default=4, type=int,
+                help='CPU cores each trial is pinned to (default: 4)')
+    parser.add_argument('--parallel', default=0, type=int,
+                help='most trials run at a time (default: 0, as many as the cores allow)')
+    parser.add_argument('--cache-dir', dest='cache_dir', default='', type=str,
+                help='shared dataset cache, built once for every image size in the space')
+    parser.add_argument('--cache-workers', dest='cache_workers', default=4, type=int,
+                help='processes building the cache (default: 4)')
+    parser.add_argument('--grace-epochs', dest='grace_epochs', default=2, type=int,
+                help='epochs every trial runs before it can be stopped early (default: 2)')
+    parser.add_argument('--min-peers', dest='min_peers', default=3, type=int,
+                help='other trials that must have reached an epoch to stop a trial there (default: 3)')
+    parser.add_argument('--poll', default=10.0, type=float,
+                help='seconds between checks of the running trials (default: 10)')
+    args = parser.parse_args()
+
+    runSweep(config.readFile(args.space), args.out, args.cores_per_trial, args.parallel,
+             args.cache_dir, args.grace_epochs, args.min_peers, args.poll, args.cache_workers)
+
+if __name__ == '__main__':
+    main()
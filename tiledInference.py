@@ -0,0 +1,154 @@
+'''
+Tiled inference on full resolution frames.
+
+The segmentation output of CapsNet has a fixed size, so segmenting a whole
+2048x1024 frame at once loses almost all detail. Instead the frame is split
+into overlapping square tiles, every tile is resized to the network input,
+and the class probabilities of the tiles are upsampled back to the tile size
+and blended in the overlaps with a window that is highest at the tile centre.
+
+Usage:
+    python tiledInference.py --net model.pth --data-dir <cityscapes> \
+        --json dataset/cityscapesClasses.json --imageSize 128 --tile 512 --stride 384
+'''
+
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+
+import checkpoints
+import config
+import metrics
+import models.matrixCapsules as capsNet
+import utils
+
+def tileStarts(size, tile, stride):
+    '''
+        Start offsets of the tiles along one axis, the last tile ends at
+        the border.
+    '''
+    if size <= tile:
+        return [0]
+    starts = list(range(0, size - tile + 1, stride))
+    if starts[-1] != size - tile:
+        starts.append(size - tile)
+    return starts
+
+def blendWindow(tile, device=None):
+    '''
+        [tile, tile] weights falling off linearly from the centre towards the
+        border, never reaching zero so every pixel is covered.
+    '''
+    ramp = torch.arange(tile, device=device, dtype=torch.float32) + 0.5
+    ramp = torch.min(ramp, tile - ramp) / (tile / 2.0)
+    return ramp.view(-1, 1) * ramp.view(1, -1)
+
+def segmentTiled(model, frame, imageSize, tile=512, stride=384, tile_batch=8, lambda_=0.9):
+    '''
+        Segments one [3, H, W] frame with values in [0, 1].
+        Tiles are run through the model tile_batch at a time.
+        Returns the [H, W] class index map (uint8).
+    '''
+    _, H, W = frame.shape
+    tile = min(tile, H, W)
+    nc = model.num_classes
+    probs = frame.new_zeros(nc, H, W)
+    norm = frame.new_zeros(1, H, W)
+    window = blendWindow(tile, frame.device)
+    boxes = [(y, x) for y in tileStarts(H, tile, stride) for x in tileStarts(W, tile, stride)]
+    for start in range(0, len(boxes), tile_batch):
+        chunk = boxes[start:start + tile_batch]
+        tiles = torch.stack([frame[:, y:y + tile, x:x + tile] for y, x in chunk])
+        tiles = F.interpolate(tiles, size=(imageSize, imageSize), mode='nearest')
+        _, seg = model(tiles, lambda_)
+        seg = F.interpolate(seg.float(), size=(tile, tile), mode='bilinear', align_corners=False)
+        for (y, x), p in zip(chunk, seg):
+            probs[:, y:y + tile, x:x + tile] += p * window
+            norm[:, y:y + tile, x:x + tile] += window
+    return (probs / norm).argmax(0).byte()
+
+def segmentResized(model, frame, imageSize, lambda_=0.9):
+    '''
+        Baseline: segments the whole [3, H, W] frame resized to the network
+        input, upsampling the output back to the frame size.
+    '''
+    _, H, W = frame.shape
+    x = F.interpolate(frame.unsqueeze(0), size=(imageSize, imageSize), mode='nearest')
+    _, seg = model(x, lambda_)
+    seg = F.interpolate(seg.float(), size=(H, W), mode='bilinear', align_corners=False)
+    return seg[0].argmax(0).byte()
+
+def main():
+    from dataset.cityscapesDataLoader import cityscapesDataset
+
+    parser = argparse.ArgumentParser(description='Tiled CapsNet inference on full resolution frames')
+    parser.add_argument('--net', default='',
+                help='path to the trained network')
+    parser.add_argument('--data-dir', dest='data_dir', required=True,
+                help='cityscapes root directory')
+    parser.add_argument('--json', required=True,
+                help='json file with the class definitions')
+    parser.add_argument('--split', default='val',
+                help='split to evaluate (default: val)')
+    parser.add_argument('--imageSize', default=128, type=int,
+                help='height/width of the input image to the network')
+    parser.add_argument('--config', default='',
+                help='run config the network was trained with, if --net does not store one (see config.py)')
+    parser.add_argument('--r', type=int, default=3,
+                help='Number of Routing Iterations')
+    parser.add_argument('--lambda', dest='lambda_', default=0.9, type=float,
+                help='inverse temperature of the routing (default: 0.9)')
+    parser.add_argument('--tile', default=512, type=int,
+                help='tile size in frame pixels (default: 512)')
+    parser.add_argument('--stride', default=384, type=int,
+                help='offset between tiles, smaller than --tile to overlap (default: 384)')
+    parser.add_argument('--tile-batch', dest='tile_batch', default=8, type=int,
+                help='tiles run through the network at a time (default: 8)')
+    parser.add_argument('--limit', default=0, type=int,
+                help='only evaluate the first N frames (default: 0, all)')
+    args = parser.parse_args()
+
+    use_gpu = torch.cuda.is_available()
+    device = 'cuda' if use_gpu else 'cpu'
+    dataset = cityscapesDataset(args.data_dir, args.split, json_path=args.json, raw=True)
+    key = utils.disentangleKey(dataset.classes)
+    nc = len(key) + 1
+    state = torch.load(args.net, map_location='cpu', weights_only=False) if args.net else None
+    run_config = config.runConfig(state, args.config)
+    model = capsNet.CapsNet(E=nc, r=args.r, use_gpu=use_gpu,
+                            **config.capsNetKwargs(run_config, nc, args.r))
+    if state is not None:
+        model.load_state_dict(checkpoints.modelState(state))
+    model.to(device).eval()
+
+    results = {}
+    frames = len(dataset) if not args.limit else min(args.limit, len(dataset))
+    for mode in ('resized', 'tiled'):
+        confusion = metrics.ConfusionMatrix(nc, device=device)
+        elapsed = 0.0
+        with torch.inference_mode():
+            for i in range(frames):
+                image, gt = dataset[i]
+                frame = image.to(device).float().div_(255)
+                label = utils.encodeLabels(gt.unsqueeze(0), key, device)
+                start = time.time()
+                if mode == 'tiled':
+                    pred = segmentTiled(model, frame, args.imageSize, args.tile, args.stride,
+                                        args.tile_batch, args.lambda_)
+                else:
+                    pred = segmentResized(model, frame, args.imageSize, args.lambda_)
+                if use_gpu:
+                    torch.cuda.synchronize()
+                elapsed += time.time() - start
+                confusion.update(pred.unsqueeze(0), label)
+        results[mode] = (frames / elapsed, confusion.pixelAccuracy(), confusion.meanIoU())
+        print('%-8s %6.2f frames/s | pixel accuracy %.4f | mIoU %.4f' % ((mode,) + results[mode]))
+
+    (fps_r, acc_r, miou_r), (fps_t, acc_t, miou_t) = results['resized'], results['tiled']
+    print('tiled vs resized: %+.4f pixel accuracy | %+.4f mIoU | %.1fx the time per frame'
+          % (acc_t - acc_r, miou_t - miou_r, fps_r / fps_t))
+
+if __name__ == '__main__':
+    main()
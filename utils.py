@@ -88,6 +88,100 @@ def disentangleKey(key):
 
     return dKey
 
+# Class index given to pixels whose colour does not belong to any class
+IGNORE_INDEX = 255
+
+# Colour lookup tables and palettes, cached per key and device
+_colorLUTs = {}
+_colorPalettes = {}
+
+def colorLUT(key, device=None):
+    '''
+        Returns the lookup table from packed 24-bit RGB values
+        (R << 16 | G << 8 | B) to class indices for the given class key.
+        The background colour [0,0,0] maps to len(key) and every other colour
+        maps to IGNORE_INDEX. The table is built once per key and device.
+    '''
+    colors = tuple(tuple(int(c) for c in key[k]) for k in range(len(key)))
+    device = torch.device(device) if device is not None else torch.device('cpu')
+    lut = _colorLUTs.get((colors, device))
+    if lut is None:
+        lut = torch.full((1 << 24,), IGNORE_INDEX, dtype=torch.uint8)
+        lut[0] = len(key) # background class
+        for k, rgb in enumerate(colors):
+            lut[(rgb[0] << 16) | (rgb[1] << 8) | rgb[2]] = k
+        lut = lut.to(device)
+        _colorLUTs[(colors, device)] = lut
+    return lut
+
+def encodeLabels(batch, key, device=None):
+    '''
+        Encodes a batch of groundtruth colour images of size
+        [batchSize, 3, H, W] with values in [0, 255] into class index maps of
+        size [batchSize, H, W] (uint8) in a single lookup.
+        Only exact colour matches are assigned a class, other pixels are
+        IGNORE_INDEX. If device is given, the encoding runs on that device.
+    '''
+    if device is not None:
+        batch = batch.to(device)
+    lut = colorLUT(key, batch.device)
+    if batch.is_floating_point():
+        rgb = batch.round()
+        exact = (rgb == batch).all(1)
+        rgb = rgb.clamp(0, 255).long()
+    else:
+        exact = None
+        rgb = batch.long()
+    packed = (rgb[:,0] << 16) | (rgb[:,1] << 8) | rgb[:,2]
+    label = lut[packed]
+    if exact is not None:
+        label = label.masked_fill(~exact, IGNORE_INDEX)
+    return label
+
+def indexToOneHot(label, num_classes, dtype=torch.float64):
+    '''
+        Converts class index maps of size [batchSize, H, W] to one-hot tensors
+        of size [batchSize, num_classes, H, W]. Pixels without a class are all
+        zeros.
+    '''
+    classes = torch.arange(num_classes, device=label.device).view(1,-1,1,1)
+    return (label.long().unsqueeze(1) == classes).to(dtype)
+
+def indexToPresence(label, num_classes, dtype=torch.float64):
+    '''
+        Returns the fraction of pixels of each class for every index map in
+        the batch, as a tensor of size [batchSize, num_classes].
+    '''
+    b = label.size(0)
+    label = label.long().view(b, -1).clamp(max=num_classes)
+    label = label + torch.arange(b, device=label.device).view(-1,1) * (num_classes + 1)
+    counts = torch.bincount(label.view(-1), minlength=b * (num_classes + 1))
+    counts = counts.view(b, num_classes + 1)[:, :num_classes]
+    return counts.to(dtype) / label.size(1)
+
+def colorPalette(key, device=None):
+    '''
+        Returns a [256, 3] uint8 tensor with the RGB colour of every class
+        index in the key. The background class and IGNORE_INDEX are black.
+        The palette is built once per key and device.
+    '''
+    colors = tuple(tuple(int(c) for c in key[k]) for k in range(len(key)))
+    device = torch.device(device) if device is not None else torch.device('cpu')
+    palette = _colorPalettes.get((colors, device))
+    if palette is None:
+        palette = torch.zeros(256, 3, dtype=torch.uint8)
+        palette[:len(colors)] = torch.tensor(colors, dtype=torch.uint8)
+        palette = palette.to(device)
+        _colorPalettes[(colors, device)] = palette
+    return palette
+
+def indexToColor(label, key):
+    '''
+        Converts class index maps of size [batchSize, H, W] to RGB images of
+        size [batchSize, H, W, 3] (uint8), on the device of the labels.
+    '''
+    return colorPalette(key, label.device)[label.long()]
+
 def generatePresenceVector(batch, key):
     '''
         Generate a vector with dimensions of classes equal to the number of
@@ -95,151 +189,50 @@ def generatePresenceVector(batch, key):
         class in the image: It is 1 if a certain class is present, or 0 if it
         is absent.
     '''
-    batch = batch.numpy()
-    # Iterate over all images in a batch
-    for i in range(len(batch)):
-        img = batch[i,:,:,:]
-        imgSize = img.shape[1] * img.shape[2]
-        img = np.transpose(img, (1,2,0))
-        presence = np.zeros(len(key) + 1) # +1 for the background class
-
-        # Iterate over all the key-value pairs in the class Key dict
-        for k in range(len(key)):
-            rgb = key[k]
-            mask = np.where(np.all(img == rgb, axis = -1))
-            presence[k] = len(mask[0])/imgSize
-
-        # Check for background pixels [0,0,0]
-        rgb = np.array([0,0,0])
-        mask = np.where(np.all(img == rgb, axis = -1))
-        presence[19] = len(mask[0])/imgSize
-
-        presence = torch.from_numpy(presence).unsqueeze(0)
-
-        if 'label' in locals():
-            label = torch.cat((label, presence), 0)
-        else:
-            label = presence
-
-    return label
+    return indexToPresence(encodeLabels(batch, key), len(key) + 1) # +1 for the background class
 
 def generateOneHot(gt, key):
     '''
         Generates the one-hot encoded tensor for a batch of images based on
         their class.
     '''
-
-    batch = gt.numpy()
-    # Iterate over all images in a batch
-    for i in range(len(batch)):
-        img = batch[i,:,:,:]
-        img = np.transpose(img, (1,2,0))
-        catMask = np.ones((img.shape[0], img.shape[1]))
-        # Multiply by 19 since 19 is considered label for the background class
-
-        # Iterate over all the key-value pairs in the class Key dict
-        for k in range(len(key) + 1):
-            catMask = catMask * 0
-            if k == 19:
-                rgb = [0, 0, 0]
-            else:
-                rgb = key[k]
-            mask = np.where(np.all(img == rgb, axis = -1))
-            catMask[mask] = 1
-
-            catMaskTensor = torch.from_numpy(catMask).unsqueeze(0)
-            if 'oneHot' in locals():
-                oneHot = torch.cat((oneHot, catMaskTensor), 0)
-            else:
-                oneHot = catMaskTensor
-
-    label = oneHot.view(len(batch),len(key)+1,img.shape[0],img.shape[1])
-    return label
+    return indexToOneHot(encodeLabels(gt, key), len(key) + 1)
 
 def reverseOneHot(batch, key):
     '''
         Generates the segmented image from the output of a segmentation network.
-        Takes a batch of tensors and returns a batch of numpy images in RGB (not BGR).
+        Takes a batch of scores of size [batchSize, num_classes, H, W] and
+        returns a batch of uint8 images of size [batchSize, H, W, 3] in RGB
+        (not BGR). A numpy batch is decoded to numpy, a tensor is decoded on
+        its device.
     '''
-
-    # Iterate over all images in a batch
-    for i in range(len(batch)):
-        vec = batch[i,:,:,:]
-        idxs = np.argmax(vec, axis=0)
-
-        segSingle = np.zeros([idxs.shape[0], idxs.shape[1], 3])
-
-        # Iterate over all the key-value pairs in the class Key dict
-        for k in range(len(key)):
-            rgb = key[k]
-            mask = idxs == k
-            #mask = np.where(np.all(idxs == k, axis=-1))
-            segSingle[mask] = rgb
-
-        segMask = np.expand_dims(segSingle, axis=0)
-        if 'generated' in locals():
-            generated = np.concatenate((generated, segMask), axis=0)
-        else:
-            generated = segMask
-
-    return generated
+    if torch.is_tensor(batch):
+        return indexToColor(batch.argmax(1), key)
+    idxs = np.argmax(batch, axis=1).astype(np.uint8)
+    return colorPalette(key).numpy()[idxs]
 
 def generateGTmask(batch, key):
     '''
         Generates the category-wise encoded vector for the segmentation classes
         for a batch of images.
-        Returns a tensor of size: [batchSize, imgSize**2, 1]
-    '''
-    batch = batch.numpy()
-    # Iterate over all images in a batch
-    for i in range(len(batch)):
-        img = batch[i,:,:,:]
-        img = np.transpose(img, (1,2,0))
-        cat_mask = np.ones((img.shape[0], img.shape[1]))
-        # Multiply by 19 since 19 is considered label for the background class
-        cat_mask = cat_mask * 19
-
-        # Iterate over all the key-value pairs in the class Key dict
-        for k in range(len(key)):
-            rgb = key[k]
-            mask = np.where(np.all(img == rgb, axis = -1))
-            cat_mask[mask] = k
-
-        cat_mask = torch.from_numpy(cat_mask).view(-1,1).unsqueeze(0)
-
-        if 'label' in locals():
-            label = torch.cat((label, cat_mask), 0)
-        else:
-            label = cat_mask
-        #print('img copy masked')
-        #print(img_copy)
-
-    label = torch.squeeze(label, dim=2)
-    return label
+        Returns a tensor of size: [batchSize, imgSize**2]
+    '''
+    label = encodeLabels(batch, key)
+    # len(key) is the label for the background class, also used for pixels
+    # that do not belong to any class
+    label = label.masked_fill(label == IGNORE_INDEX, len(key))
+    return label.view(label.size(0), -1).double()
 
 def labelToImage(label, key):
     '''
         Generates the image from the output label.
         Basically the inverse process of the generateGTmask function.
+        Decodes the first label of the batch into a uint8 RGB image of size
+        [H, W, 3]; values which are not a class index are white.
     '''
-
     img_dim = int(math.sqrt(label.shape[1]))
-    label = label[0,:]
-    label = np.around(label).astype(int)
-    #print(label)
-    #print(np.min(label))
-    gen = np.ones((label.shape[0], 3)) * 255
-
-    for k in range(len(key) + 1):
-        if k == 19:
-            rgb = [0, 0, 0]
-        else:
-            rgb = key[k]
-        mask = label == k
-        gen[mask] = rgb
-
-    # print(gen)
-
-    gen = np.reshape(gen, (img_dim, img_dim, 3))
-
-    return gen
+    label = np.around(label[0,:]).astype(int)
+    palette = np.full((len(key) + 2, 3), 255, dtype=np.uint8)
+    palette[:len(key) + 1] = colorPalette(key).numpy()[:len(key) + 1]
+    label = np.where((label >= 0) & (label <= len(key)), label, len(key) + 1)
+    return palette[label].reshape(img_dim, img_dim, 3)
@@ -0,0 +1,155 @@
+'''
+Asynchronous visualization of training samples.
+
+The training loop hands a snapshot of the first sample of a batch to a
+SampleVisualizer, which renders the input | prediction | groundtruth strip on
+a background thread. Strips are written to image files by that thread, or
+shown in a window if no output directory is given and a display is
+available. HighGUI calls must stay on the main thread, so the window is
+updated by submit (and show) with the latest rendered strip. Submitting
+never waits for rendering: when the renderer is behind, the sample is
+dropped.
+'''
+
+import os
+import queue
+import threading
+
+import cv2
+import numpy as np
+import torch
+
+import utils
+
+_STOP = object()
+
+def displayAvailable():
+    '''
+        True if cv2 windows can be opened on this machine.
+    '''
+    if os.name == 'nt' or os.uname()[0] == 'Darwin':
+        return True
+    return bool(os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'))
+
+def renderStrip(image, seg, gt, palette):
+    '''
+        Renders one sample as a single BGR uint8 image.
+
+        Args:
+            image: [3, H, W] input image in [0, 1]
+            seg: [num_classes, h, w] segmentation output
+            gt: [3, H, W] groundtruth colour image in [0, 1]
+            palette: [256, 3] uint8 colour of every class index
+    '''
+    H, W = image.shape[1:]
+    image = (image.clamp(0, 1) * 255).round().byte().permute(1,2,0).numpy()
+    gt = (gt.clamp(0, 1) * 255).round().byte().permute(1,2,0).numpy()
+    pred = palette[seg.argmax(0)].numpy()
+    if pred.shape[:2] != (H, W):
+        pred = cv2.resize(pred, (W, H), interpolation=cv2.INTER_NEAREST)
+    stacked = np.concatenate((image, pred, gt), axis=1)
+    return cv2.cvtColor(stacked, cv2.COLOR_RGB2BGR)
+
+class SampleVisualizer(object):
+    '''
+        Renders training samples on a background thread.
+
+        Args:
+            key: class key from utils.disentangleKey
+            interval: render one sample every N steps (0 never renders)
+            out_dir: directory the strips are written to; if not set they are
+                     shown in a window when a display is available, from
+                     the thread calling submit, which must be the main one
+            max_pending: samples waiting to be rendered before new ones are
+                         dropped
+    '''
+
+    def __init__(self, key, interval=1, out_dir=None, max_pending=2):
+        self.interval = interval
+        self.out_dir = out_dir
+        self.window = not out_dir and displayAvailable()
+        self.palette = utils.colorPalette(key)
+        self.dropped = 0
+        self.queue = queue.Queue(max_pending)
+        self.rendered = queue.Queue(1) # latest strip waiting for the window
+        self.thread = None
+        if out_dir and not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        if interval and not (out_dir or self.window):
+            print('No display available and no visualization directory set, '
+                  'samples are not rendered')
+        if self.enabled:
+            self.thread = threading.Thread(target=self._run, name='SampleVisualizer',
+                                           daemon=True)
+            self.thread.start()
+
+    @property
+    def enabled(self):
+        return bool(self.interval) and bool(self.out_dir or self.window)
+
+    def submit(self, step, image, seg, gt, tag=''):
+        '''
+            Queues the first sample of the batch for rendering if step falls
+            on the interval. Only the sample itself is copied to the CPU.
+        '''
+        if not self.enabled:
+            return
+        self.show()
+        if step % self.interval != 0:
+            return
+        with torch.no_grad():
+            sample = [t[0].detach().float().cpu() for t in (image, seg, gt)]
+        try:
+            self.queue.put_nowait((step, tag, sample))
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                break
+            step, tag, (image, seg, gt) = item
+            try:
+                strip = renderStrip(image, seg, gt, self.palette)
+                if self.out_dir:
+                    name = '%ssample_%06d.png' % (tag + '_' if tag else '', step)
+                    cv2.imwrite(os.path.join(self.out_dir, name), strip)
+                else:
+                    # Replace a strip the main thread has not shown yet
+                    try:
+                        self.rendered.get_nowait()
+                    except queue.Empty:
+                        pass
+                    self.rendered.put_nowait(strip)
+            except Exception as e:
+                # Rendering must never take the training down
+                print('Visualization failed: %s' % e)
+
+    def show(self):
+        '''
+            Shows the latest rendered strip in the window, if there is a new
+            one. Must be called from the main thread.
+        '''
+        if not self.window:
+            return
+        try:
+            strip = self.rendered.get_nowait()
+        except queue.Empty:
+            return
+        try:
+            cv2.namedWindow('Input | Gen | GT', cv2.WINDOW_NORMAL)
+            cv2.imshow('Input | Gen | GT', strip)
+            cv2.waitKey(1)
+        except Exception as e:
+            print('Visualization failed: %s' % e)
+
+    def close(self):
+        '''
+            Renders the queued samples and stops the background thread.
+        '''
+        if self.thread is not None:
+            self.queue.put(_STOP)
+            self.thread.join()
+            self.thread = None
+            self.show()